@@ -10,7 +10,9 @@ from app.redis_store import RedisStore
 from app.config import Config
 from app.resources import api_blueprint
 from wtforms import SelectField
-from app.search import Elastic
+from app.search import Elastic, IndexQueue
+from app.cache import ResponseCache
+from app.versions import VersionStore
 from werkzeug.middleware.shared_data import SharedDataMiddleware
 from app.forms import AdminLoginForm
 
@@ -23,6 +25,9 @@ jwt = JWTManager()
 cors = CORS()
 redis_store = RedisStore()
 es = Elastic()
+index_queue = IndexQueue()
+response_cache = ResponseCache()
+versions = VersionStore()
 
 
 def createApp(app_config=Config):
@@ -41,7 +46,10 @@ def createApp(app_config=Config):
     mail.init_app(app)
     jwt.init_app(app)
     redis_store.init_app(app)
-    es.init_app(app, db)
+    response_cache.init_app(app, redis_store)
+    versions.init_app(app, redis_store)
+    es.init_app(app, db, redis_store)
+    index_queue.init_app(app, redis_store)
 
     with app.app_context():
         register_blueprint(app)
@@ -49,6 +57,15 @@ def createApp(app_config=Config):
         register_apis(api)
         register_admin_views(admin_app, app, views)
 
+    from app.tag_index import tag_index
+    from app.suggest_index import suggest_index
+    from app.cart_store import cart_store
+
+    cart_store.init_app(app, redis_store)
+
+    app.before_first_request(tag_index.warm_up)
+    app.before_first_request(suggest_index.warm_up)
+
     app.add_url_rule("/uploads/<filename>", "uploaded_file", build_only=True)
     app.wsgi_app = SharedDataMiddleware(
         app.wsgi_app, {"/uploads": app.config["UPLOAD_FOLDER"]}
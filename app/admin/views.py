@@ -11,8 +11,9 @@ from wtforms.fields.html5 import EmailField
 from flask import request, flash, current_app as app
 from werkzeug.utils import secure_filename
 from PIL import Image
-from flask import url_for, redirect, session
-from app.models import User, ProductSpecifications, Product
+from flask import url_for, redirect, session, g
+from app.models import User, Product, ProductSpecifications
+from app.catalog import catalog_changed, snapshot, unlinked_product_ids
 from cloudinary.uploader import upload, destroy
 from cloudinary.utils import cloudinary_url
 import os
@@ -56,7 +57,23 @@ class StaffModelView(ModelView):
         return redirect(url_for("admin.index"))
 
 
-class ProductAdminView(StaffModelView):
+class CatalogModelView(StaffModelView):
+    def on_model_change(self, form, model, is_created):
+        # Products taken off by the form are not linked once committed.
+        g.catalog_unlinked = unlinked_product_ids(model)
+
+    def after_model_change(self, form, model, is_created):
+        catalog_changed(model, snapshot(model, g.pop("catalog_unlinked", ())))
+
+    def on_model_delete(self, model):
+        # Relationships are gone once the delete is committed.
+        g.catalog_change = snapshot(model)
+
+    def after_model_delete(self, model):
+        catalog_changed(model, g.pop("catalog_change", None))
+
+
+class ProductAdminView(CatalogModelView):
     column_list = (
         "name",
         "slug",
@@ -108,31 +125,39 @@ class ProductAdminView(StaffModelView):
     )
 
     def on_model_change(self, form, model, is_created):
+        super().on_model_change(form, model, is_created)
         if not model.slug:
             model.slug = slugify(model.name)
+        with self.session.no_autoflush:
+            taken = (
+                self.session.query(Product.id)
+                .filter(Product.slug == model.slug, Product.id != model.id)
+                .first()
+            )
+        if taken:
+            raise validators.ValidationError(
+                f"Slug '{model.slug}' is already used by another product."
+            )
 
         if is_created:
             model.date_created = datetime.utcnow()
         else:
             model.date_updated = datetime.utcnow()
 
-    def after_model_change(self, form, model, is_created):
-        Product.reindex()
-
 
-class ProductSpecificationsAdminView(StaffModelView):
+class ProductSpecificationsAdminView(CatalogModelView):
     column_list = ("product.name",)
     column_sortable_list = ("product.name",)
     column_filters = ("product.name",)
 
 
-class ProdudctFeatureAdminView(StaffModelView):
+class ProdudctFeatureAdminView(CatalogModelView):
     column_list = ("title", "description", "products")
     column_hide_backrefs = False
     column_sortable_list = ("title",)
 
 
-class ProductTagAdminView(StaffModelView):
+class ProductTagAdminView(CatalogModelView):
     column_list = (
         "name",
         "slug",
@@ -142,14 +167,12 @@ class ProductTagAdminView(StaffModelView):
     column_sortable_list = ("name",)
 
     def on_model_change(self, form, model, is_created):
+        super().on_model_change(form, model, is_created)
         if not model.slug:
             model.slug = slugify(model.name)
 
-    def after_model_change(self, form, model, is_created):
-        Product.reindex()
-
 
-class ProductImageAdminView(StaffModelView):
+class ProductImageAdminView(CatalogModelView):
     def _list_thumbnail(view, context, model, name):
         if model.thumbnail_url:
             # url = url_for(
@@ -309,11 +332,8 @@ class ProductImageAdminView(StaffModelView):
             except OSError as ex:
                 print(ex)
 
-    def after_model_change(self, form, model, is_created):
-        Product.reindex()
-
 
-class BrandAdminView(StaffModelView):
+class BrandAdminView(CatalogModelView):
     column_list = (
         "name",
         "slug",
@@ -323,6 +343,7 @@ class BrandAdminView(StaffModelView):
     column_sortable_list = ("name",)
 
     def on_model_change(self, form, model, is_created):
+        super().on_model_change(form, model, is_created)
         if not model.slug:
             model.slug = slugify(model.name)
 
@@ -432,9 +453,6 @@ class UserAdminView(AdminModelView):
             self.after_model_change(form, model, False)
         return True
 
-    def after_model_change(self, form, model, is_created):
-        Product.reindex()
-
 
 class OrderManageAdminView(StaffModelView):
     column_list = (
@@ -0,0 +1,85 @@
+from flask import g, request
+from flask_restplus.utils import unpack
+from functools import wraps
+from redis import RedisError
+import hashlib
+import json
+
+
+class ResponseCache(object):
+    """Caches marshalled GET responses in Redis.
+
+    Every entry is registered under a set of surrogate tags (``product:1``,
+    ``brand:2``, ``products`` ...) so that a write can purge exactly the
+    entries that rendered the changed rows.
+    """
+
+    KEY_PREFIX = "response:"
+    TAG_PREFIX = "response-tag:"
+
+    def __init__(self, app=None, redis_store=None):
+        self.redis_store = redis_store
+        self.ttl = None
+        if app:
+            self.init_app(app, redis_store)
+
+    def init_app(self, app, redis_store):
+        self.redis_store = redis_store
+        self.ttl = app.config["RESPONSE_CACHE_TTL"]
+
+    def tag(self, *tags):
+        """Attach surrogate tags to the response being built."""
+        if "response_cache_tags" in g:
+            g.response_cache_tags.update(tags)
+
+    def cached(self, *tags):
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                key = self._make_key()
+                try:
+                    entry = self.redis_store.object.get(key)
+                except RedisError as ex:
+                    print(ex)
+                    return func(*args, **kwargs)
+                if entry is not None:
+                    return json.loads(entry), 200
+
+                g.response_cache_tags = set(tags)
+                data, code, headers = unpack(func(*args, **kwargs))
+                if code == 200:
+                    self._store(key, data, g.pop("response_cache_tags"))
+                return data, code, headers
+
+            return wrapper
+
+        return decorator
+
+    def purge(self, *tags):
+        tag_keys = [self.TAG_PREFIX + tag for tag in tags]
+        if not tag_keys:
+            return
+        try:
+            keys = self.redis_store.object.sunion(tag_keys)
+            self.redis_store.object.delete(*keys, *tag_keys)
+        except RedisError as ex:
+            print(ex)
+
+    def _make_key(self):
+        args = sorted((name, sorted(values)) for name, values in request.args.lists())
+        view_args = sorted((request.view_args or {}).items())
+        digest = hashlib.sha1(
+            json.dumps([view_args, args], default=str).encode()
+        ).hexdigest()
+        return f"{self.KEY_PREFIX}{request.endpoint}:{digest}"
+
+    def _store(self, key, data, tags):
+        try:
+            pipe = self.redis_store.object.pipeline()
+            pipe.set(key, json.dumps(data), ex=self.ttl)
+            for tag in tags:
+                pipe.sadd(self.TAG_PREFIX + tag, key)
+                pipe.expire(self.TAG_PREFIX + tag, self.ttl)
+            pipe.execute()
+        except RedisError as ex:
+            print(ex)
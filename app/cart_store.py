@@ -0,0 +1,273 @@
+from sqlalchemy import case, event
+from redis import RedisError
+from app import db
+from app.models import Cart, CartLine
+
+
+def read_cart_lines(cart_id):
+    """``(id, product_id, quantity)`` rows of a cart."""
+    return (
+        db.session.query(CartLine.id, CartLine.product_id, CartLine.quantity)
+        .filter(CartLine.cart_id == cart_id)
+        .all()
+    )
+
+
+def update_line_quantities(quantities):
+    """Set ``{line_id: quantity}`` with one UPDATE ... CASE statement."""
+    if quantities:
+        CartLine.query.filter(CartLine.id.in_(list(quantities))).update(
+            {CartLine.quantity: case(quantities, value=CartLine.id)},
+            synchronize_session=False,
+        )
+
+
+def add_line_quantities(deltas):
+    """Add ``{line_id: delta}`` to the stored quantities in one UPDATE."""
+    if deltas:
+        CartLine.query.filter(CartLine.id.in_(list(deltas))).update(
+            {CartLine.quantity: CartLine.quantity + case(deltas, value=CartLine.id)},
+            synchronize_session=False,
+        )
+
+
+def save_cart_lines(cart_id, quantities, lines=None):
+    """Make ``cart_lines`` of a cart match ``{product_id: quantity}``.
+
+    ``lines`` are the current rows when the caller already read them. Then
+    at most one delete, one update and one multi-row insert. The caller
+    commits.
+    """
+    if lines is None:
+        lines = read_cart_lines(cart_id)
+    existing = {
+        product_id: (line_id, quantity) for line_id, product_id, quantity in lines
+    }
+    removed = [
+        line_id
+        for product_id, (line_id, _) in existing.items()
+        if product_id not in quantities
+    ]
+    changed = {
+        line_id: quantities[product_id]
+        for product_id, (line_id, quantity) in existing.items()
+        if product_id in quantities and quantities[product_id] != quantity
+    }
+    added = [
+        {"cart_id": cart_id, "product_id": product_id, "quantity": quantity}
+        for product_id, quantity in quantities.items()
+        if product_id not in existing
+    ]
+    if removed:
+        CartLine.query.filter(CartLine.id.in_(removed)).delete(
+            synchronize_session=False
+        )
+    update_line_quantities(changed)
+    if added:
+        db.session.bulk_insert_mappings(CartLine, added)
+
+
+class CartStore(object):
+    """Open carts kept in Redis hashes of product id -> quantity.
+
+    A hash is loaded from ``cart_lines`` the first time an open cart is
+    touched and is changed in place by Lua scripts, so a cart mutation is
+    one Redis round trip. Changed carts are remembered in a set and written
+    back to the database by ``flush``: on checkout, on merge and from the
+    ``flask mng flush-carts`` job. While a cart lives here its line ids are
+    its product ids.
+    """
+
+    KEY = "cart-lines:{}"
+    DIRTY_KEY = "cart-lines:dirty"
+    # Marks a loaded hash, so that an empty cart still has a key.
+    LOADED = "loaded"
+
+    LOAD_SCRIPT = """
+        if redis.call('EXISTS', KEYS[1]) == 0 then
+            redis.call('HSET', KEYS[1], unpack(ARGV, 2))
+        end
+        redis.call('EXPIRE', KEYS[1], ARGV[1])
+        return 1
+    """
+
+    # Returns nil when the cart is not loaded, the new quantity otherwise.
+    ADD_SCRIPT = """
+        if redis.call('EXISTS', KEYS[1]) == 0 then
+            return nil
+        end
+        local quantity = redis.call('HINCRBY', KEYS[1], ARGV[1], ARGV[2])
+        redis.call('SADD', KEYS[2], ARGV[4])
+        redis.call('EXPIRE', KEYS[1], ARGV[3])
+        return quantity
+    """
+
+    # Returns nil when the cart is not loaded, 0 when the line is missing.
+    SET_SCRIPT = """
+        if redis.call('EXISTS', KEYS[1]) == 0 then
+            return nil
+        end
+        if redis.call('HEXISTS', KEYS[1], ARGV[1]) == 0 then
+            return 0
+        end
+        if ARGV[2] == '0' then
+            redis.call('HDEL', KEYS[1], ARGV[1])
+        else
+            redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+        end
+        redis.call('SADD', KEYS[2], ARGV[4])
+        redis.call('EXPIRE', KEYS[1], ARGV[3])
+        return 1
+    """
+
+    # Applies (op, product id, quantity) triples from ARGV[3] on, atomically.
+    BATCH_SCRIPT = """
+        if redis.call('EXISTS', KEYS[1]) == 0 then
+            return nil
+        end
+        for i = 3, #ARGV, 3 do
+            local op, product_id, quantity = ARGV[i], ARGV[i + 1], ARGV[i + 2]
+            if op == 'add' then
+                redis.call('HINCRBY', KEYS[1], product_id, quantity)
+            elseif op == 'set' and quantity ~= '0' then
+                redis.call('HSET', KEYS[1], product_id, quantity)
+            else
+                redis.call('HDEL', KEYS[1], product_id)
+            end
+        end
+        redis.call('SADD', KEYS[2], ARGV[2])
+        redis.call('EXPIRE', KEYS[1], ARGV[1])
+        return 1
+    """
+
+    def __init__(self):
+        self.redis_store = None
+        self.enabled = False
+        self.ttl = None
+
+    def init_app(self, app, redis_store):
+        self.redis_store = redis_store
+        self.enabled = app.config["CART_STORAGE"] == "redis"
+        self.ttl = app.config["CART_REDIS_TTL"]
+        self._load = redis_store.object.register_script(self.LOAD_SCRIPT)
+        self._add = redis_store.object.register_script(self.ADD_SCRIPT)
+        self._set = redis_store.object.register_script(self.SET_SCRIPT)
+        self._batch = redis_store.object.register_script(self.BATCH_SCRIPT)
+
+    def load(self, cart_id):
+        """Load an open cart into Redis, False if there is no such cart."""
+        cart = Cart.query.filter_by(id=cart_id, status=Cart.CartStatus.OPEN).first()
+        if not cart:
+            return False
+        lines = db.session.query(CartLine.product_id, CartLine.quantity).filter(
+            CartLine.cart_id == cart_id
+        )
+        fields = [self.LOADED, 1]
+        for product_id, quantity in lines:
+            fields.extend((product_id, quantity))
+        self._load(keys=[self.KEY.format(cart_id)], args=[self.ttl, *fields])
+        return True
+
+    def lines(self, cart_id):
+        """``{product_id: quantity}`` of an open cart, None if there is none."""
+        values = self.redis_store.object.hgetall(self.KEY.format(cart_id))
+        if not values:
+            if not self.load(cart_id):
+                return None
+            values = self.redis_store.object.hgetall(self.KEY.format(cart_id))
+        return self._quantities(values)
+
+    def add(self, cart_id, product_id, quantity=1):
+        """Add to a line, returning its quantity or None without a cart."""
+        return self._run(self._add, cart_id, product_id, quantity)
+
+    def set(self, cart_id, product_id, quantity):
+        """Set (or with 0, remove) an existing line.
+
+        Returns None without a cart, False without the line.
+        """
+        result = self._run(self._set, cart_id, product_id, quantity)
+        return None if result is None else bool(result)
+
+    def remove(self, cart_id, product_id):
+        return self.set(cart_id, product_id, 0)
+
+    def apply(self, cart_id, operations):
+        """Apply ``(op, product_id, quantity)`` operations in one script.
+
+        Returns False without a cart.
+        """
+        keys = [self.KEY.format(cart_id), self.DIRTY_KEY]
+        args = [self.ttl, cart_id]
+        for operation in operations:
+            args.extend(operation)
+        result = self._batch(keys=keys, args=args)
+        if result is None and self.load(cart_id):
+            result = self._batch(keys=keys, args=args)
+        return result is not None
+
+    def _run(self, script, cart_id, product_id, value):
+        keys = [self.KEY.format(cart_id), self.DIRTY_KEY]
+        args = [product_id, value, self.ttl, cart_id]
+        result = script(keys=keys, args=args)
+        if result is None and self.load(cart_id):
+            result = script(keys=keys, args=args)
+        return result
+
+    def flush(self, cart_id):
+        """Write a cart's hash to ``cart_lines`` in the current transaction.
+
+        The caller commits. The dirty mark is cleared before the hash is
+        read, so writes made meanwhile set it again, and is restored if the
+        transaction ends without a commit.
+        """
+        db.session.info.setdefault("flushed_carts", set()).add(cart_id)
+        self.redis_store.object.srem(self.DIRTY_KEY, cart_id)
+        values = self.redis_store.object.hgetall(self.KEY.format(cart_id))
+        if not values:
+            return
+        save_cart_lines(cart_id, self._quantities(values))
+
+    def _quantities(self, values):
+        return {
+            int(product_id): int(quantity)
+            for product_id, quantity in values.items()
+            if product_id != self.LOADED
+        }
+
+    @staticmethod
+    def after_commit(session):
+        session.info.pop("flushed_carts", None)
+
+    def after_transaction_end(self, session, transaction):
+        if transaction.parent is not None:
+            return
+        cart_ids = session.info.pop("flushed_carts", None)
+        if cart_ids:
+            try:
+                self.mark_dirty(*cart_ids)
+            except RedisError as ex:
+                print(ex)
+
+    def mark_dirty(self, *cart_ids):
+        if cart_ids:
+            self.redis_store.object.sadd(self.DIRTY_KEY, *cart_ids)
+
+    def dirty(self, count):
+        """Up to ``count`` ids of carts changed since their last flush."""
+        cart_ids = self.redis_store.object.srandmember(self.DIRTY_KEY, count)
+        return [int(cart_id) for cart_id in cart_ids]
+
+    def drop(self, *cart_ids):
+        """Forget carts, the next access loads them from the database."""
+        if cart_ids:
+            self.redis_store.object.delete(
+                *(self.KEY.format(cart_id) for cart_id in cart_ids)
+            )
+            self.redis_store.object.srem(self.DIRTY_KEY, *cart_ids)
+
+
+cart_store = CartStore()
+
+event.listen(db.session, "after_commit", CartStore.after_commit)
+event.listen(db.session, "after_transaction_end", cart_store.after_transaction_end)
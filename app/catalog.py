@@ -0,0 +1,186 @@
+from flask_restplus import marshal
+from datetime import datetime
+from sqlalchemy import inspect
+from app import db, response_cache, versions
+from app.models import (
+    Product,
+    ProductBrand,
+    ProductTag,
+    ProductImage,
+    ProductFeature,
+    ProductSpecifications,
+    ProductDocument,
+    product_and_tag_assoc,
+    product_and_feature_assoc,
+)
+from app.tag_index import tag_index
+from app.suggest_index import suggest_index
+import json
+
+# Tables a rendered product reads from.
+PRODUCT_TABLES = (
+    Product.__tablename__,
+    ProductBrand.__tablename__,
+    ProductTag.__tablename__,
+    ProductImage.__tablename__,
+    ProductFeature.__tablename__,
+    ProductSpecifications.__tablename__,
+)
+# Products rendered and stored per query.
+DOCUMENT_WINDOW = 500
+
+
+def product_tags(product):
+    """Surrogate tags for a rendered product, or a row with id and brand_id."""
+    tags = [f"product:{product.id}"]
+    if product.brand_id:
+        tags.append(f"brand:{product.brand_id}")
+    return tags
+
+
+def affected_product_ids(model):
+    """Ids of the products whose rendering includes ``model``."""
+    if isinstance(model, Product):
+        return [model.id]
+    if isinstance(model, ProductImage):
+        return [model.product_id] if model.product_id else []
+    if isinstance(model, ProductBrand):
+        query = db.session.query(Product.id).filter(Product.brand_id == model.id)
+    elif isinstance(model, ProductSpecifications):
+        query = db.session.query(Product.id).filter(
+            Product.specifications_id == model.id
+        )
+    elif isinstance(model, ProductTag):
+        query = db.session.query(product_and_tag_assoc.c.product_id).filter(
+            product_and_tag_assoc.c.product_tag_id == model.id
+        )
+    elif isinstance(model, ProductFeature):
+        query = db.session.query(product_and_feature_assoc.c.product_id).filter(
+            product_and_feature_assoc.c.product_feature_id == model.id
+        )
+    else:
+        return []
+    return [product_id for product_id, in query]
+
+
+def unlinked_product_ids(model):
+    """Ids of the products a pending edit of ``model`` takes away from it.
+
+    Read from the attribute history before the commit, because the
+    committed row no longer lists them.
+    """
+    attrs = inspect(model).attrs
+    product_ids = set()
+    for name in ("products", "product"):
+        if name in attrs:
+            product_ids.update(
+                product.id
+                for product in attrs[name].history.deleted
+                if product is not None and product.id
+            )
+    return product_ids
+
+
+def snapshot(model, unlinked=()):
+    """What catalog_changed needs to know, read while the row still exists.
+
+    ``unlinked`` are product ids the write took away from ``model``.
+    """
+    product_ids = sorted(set(affected_product_ids(model)) | set(unlinked))
+    tags = [f"product:{product_id}" for product_id in product_ids]
+    if isinstance(model, Product):
+        # Any product write may move it in or out of a listing and
+        # changes the brand and tag product counts.
+        tags.extend(("products", "brands", "tags"))
+    elif isinstance(model, ProductBrand):
+        tags.extend((f"brand:{model.id}", "brands"))
+    elif isinstance(model, ProductTag):
+        tags.extend((f"tag:{model.id}", f"tag-slug:{model.slug}", "tags"))
+    return {
+        "table": model.__tablename__,
+        "product_ids": product_ids,
+        "tags": tags,
+    }
+
+
+def catalog_changed(model, change=None):
+    """Propagate a committed catalog write to the read side."""
+    change = change or snapshot(model)
+    versions.bump(change["table"])
+    tag_index.invalidate()
+    suggest_index.invalidate()
+    rebuild_product_documents(change["product_ids"])
+    response_cache.purge(*change["tags"])
+
+
+def _windows(ids, size):
+    ids = list(ids)
+    for start in range(0, len(ids), size):
+        yield ids[start : start + size]
+
+
+def build_product_documents(product_ids):
+    """Render documents for ``product_ids``, loading them in windows.
+
+    Returns the rendered documents keyed by product id. Ids without a
+    product are left out. Nothing is stored.
+    """
+    from app.resources.product import ProductSchema
+    from app.resources import load_plan
+
+    documents = dict()
+    for window in _windows(product_ids, DOCUMENT_WINDOW):
+        products = (
+            Product.query.options(*load_plan(ProductSchema))
+            .populate_existing()
+            .filter(Product.id.in_(window))
+        )
+        for product in products:
+            documents[product.id] = marshal(product, ProductSchema)
+    return documents
+
+
+def rebuild_product_documents(product_ids):
+    """Render and store documents for ``product_ids``, dropping stale ones.
+
+    Every window is replaced with one delete and one multi-row insert and
+    committed on its own.
+    """
+    table = ProductDocument.__table__
+    for window in _windows(product_ids, DOCUMENT_WINDOW):
+        documents = build_product_documents(window)
+        now = datetime.utcnow()
+        try:
+            db.session.execute(table.delete().where(table.c.product_id.in_(window)))
+            if documents:
+                db.session.execute(
+                    table.insert(),
+                    [
+                        {
+                            "product_id": product_id,
+                            "document": json.dumps(document),
+                            "date_updated": now,
+                        }
+                        for product_id, document in documents.items()
+                    ],
+                )
+            db.session.commit()
+        except Exception as ex:
+            # A concurrent build stored the same rows, ours are no newer.
+            print(ex)
+            db.session.rollback()
+
+
+def load_product_documents(rows):
+    """Documents for rows carrying ``id`` and ``document``.
+
+    Rows whose document has not been built yet are rendered on the spot,
+    and stored by the next catalog write or build-product-documents.
+    """
+    missing = [row.id for row in rows if row.document is None]
+    built = build_product_documents(missing)
+    return [
+        json.loads(row.document) if row.document is not None else built[row.id]
+        for row in rows
+        if row.document is not None or row.id in built
+    ]
@@ -15,6 +15,7 @@ class Config(object):
     # Redis settings:
     REDIS_HOST = "localhost"
     REDIS_PORT = 6379
+    RESPONSE_CACHE_TTL = 300
     # General settings:
     PROPAGATE_EXCEPTIONS = True
     SECRET_KEY = os.environ.get("SECRET_KEY")
@@ -26,6 +27,11 @@ class Config(object):
     ACTIVATION_EXPIRES = timedelta(minutes=30)
     # Flask-restplus settings:
     BUNDLE_ERRORS = True
+    # Cart settings: "database", or "redis" to keep open carts in Redis
+    # hashes written back by `flask mng flush-carts`, which has to run more
+    # often than CART_REDIS_TTL.
+    CART_STORAGE = "database"
+    CART_REDIS_TTL = 7 * 24 * 3600
     # Mail settings:
     # MAIL_SERVER = "localhost"
     # MAIL_PORT = 8025
@@ -42,5 +48,27 @@ class Config(object):
     # Elastic Search
     ELASTICSEARCH_URL = os.environ.get("ELASTICSEARCH_URL")
     ELASTICSEARCH_API_KEY = os.environ.get("ELASTICSEARCH_API_KEY")
+    # Queue index operations for `flask mng index-worker` instead of
+    # sending them to Elasticsearch inside the request.
+    ELASTICSEARCH_INDEX_QUEUE = True
+    # Serving settings, restored after a bulk rebuild.
+    ELASTICSEARCH_REPLICAS = 1
+    ELASTICSEARCH_REFRESH_INTERVAL = "1s"
+    ELASTICSEARCH_INDEX_VERSIONS_KEPT = 2
+    # Bulk indexing
+    ELASTICSEARCH_BULK_CHUNK_SIZE = 500
+    ELASTICSEARCH_BULK_MAX_BYTES = 10 * 1024 * 1024
+    ELASTICSEARCH_BULK_THREADS = 1
+    # Completion field used for suggestions when the in-process index
+    # cannot be built, None to disable.
+    ELASTICSEARCH_SUGGEST_FIELD = "name.suggest"
+    # Keep alive of the point in time behind cursor search pages, e.g. "1m".
+    # Needs Elasticsearch 7.10 or later, None to page without one.
+    ELASTICSEARCH_PIT_KEEP_ALIVE = None
+    # Keep a copy of the search documents in the database and search it
+    # with its full-text index when Elasticsearch is unset or failing.
+    SEARCH_LOCAL_BACKEND = True
+    # Seconds a search result stays cached, 0 to disable.
+    SEARCH_CACHE_TTL = 60
     # Cloudinary
     CLOUDINARY_URL = os.environ.get("CLOUDINARY_URL")
@@ -1,16 +1,27 @@
 from flask import Flask, current_app
-from collections import Counter
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from sqlalchemy import event
 from app.utils import get_or_create
-from app import models, db
+from app import models, db, es, index_queue, versions, response_cache
+from app.catalog import (
+    PRODUCT_TABLES,
+    build_product_documents,
+    rebuild_product_documents,
+)
+from app.cart_store import cart_store
+from app.search import compile_searchable
 from werkzeug.utils import secure_filename
 from flask_admin import form
 from PIL import Image
+from slugify import slugify
 from flask.cli import AppGroup
 import click
 import csv
 import os
 import re
 import sys
+import time
 
 
 app = current_app
@@ -27,9 +38,14 @@ def import_data(csvfile, image_basedir):
     with open(csvfile, "r") as f:
         reader = csv.DictReader(f)
         for row in reader:
+            # Slugs are unique, so a row with a known name updates it.
             product, product_created = get_or_create(
-                models.Product, db.session, name=row["name"], price=row["price"]
+                models.Product,
+                db.session,
+                slug=slugify(row["name"]),
+                defaults={"name": row["name"]},
             )
+            product.price = row["price"]
             product.description = row["description"]
 
             brand, brand_created = get_or_create(
@@ -79,6 +95,12 @@ def import_data(csvfile, image_basedir):
             if product_created:
                 counter["products_created"] += 1
 
+    rebuild_product_documents(
+        [product_id for product_id, in db.session.query(models.Product.id)]
+    )
+    versions.bump(*PRODUCT_TABLES)
+    response_cache.purge("products", "brands", "tags")
+
     print(
         "Products processed=%d (created=%d)"
         % (counter["products"], counter["products_created"])
@@ -103,3 +125,355 @@ def create_superuser():
     db.session.add(user)
     db.session.commit()
     print("Superuser is created")
+
+
+@mng_cli.command("build-product-documents", with_appcontext=True)
+def build_product_documents_command():
+    product_ids = [product_id for product_id, in db.session.query(models.Product.id)]
+    rebuild_product_documents(product_ids)
+    print("Product documents built=%d" % len(product_ids))
+
+
+@mng_cli.command("reindex", with_appcontext=True)
+@click.option("--chunk-size", type=int, help="Documents per bulk request.")
+@click.option("--threads", type=int, help="Parallel bulk requests.")
+def reindex(chunk_size, threads):
+    indexed, failed, seconds = models.Product.reindex(chunk_size, threads)
+    for item in failed:
+        print(item)
+    print(
+        "Reindexed %s: indexed=%d failed=%d (%.0f docs/s)"
+        % (
+            models.Product.__tablename__,
+            indexed,
+            len(failed),
+            indexed / seconds if seconds else indexed,
+        )
+    )
+
+
+@mng_cli.command("search-cache-stats", with_appcontext=True)
+def search_cache_stats():
+    stats = es.cache.stats()
+    lookups = stats["hits"] + stats["misses"]
+    print(
+        "Search cache (ttl=%ds): hits=%d misses=%d hit ratio=%.1f%%"
+        % (
+            es.cache.ttl,
+            stats["hits"],
+            stats["misses"],
+            100.0 * stats["hits"] / lookups if lookups else 0.0,
+        )
+    )
+
+
+def _index_entries(items):
+    searchable = models.SearchableMixin.searchable_models()
+    to_index = defaultdict(list)
+    entries = list()
+    for index, object_id, operation, _ in items:
+        if operation == "index":
+            to_index[index].append(object_id)
+        else:
+            entries.append(es.make_delete_entry(index, object_id))
+    for index, object_ids in to_index.items():
+        # Ids removed before the worker got to them become deletes.
+        entries.extend(searchable[index].entries_for_ids(index, object_ids))
+    return entries
+
+
+@mng_cli.command("index-worker", with_appcontext=True)
+@click.option("--batch-size", default=500, show_default=True)
+@click.option("--max-retries", default=5, show_default=True)
+@click.option("--backoff", default=0.5, show_default=True, help="First retry delay.")
+@click.option("--idle", default=1.0, show_default=True, help="Sleep when empty.")
+@click.option("--once", is_flag=True, help="Exit when the queue is drained.")
+def index_worker(batch_size, max_retries, backoff, idle, once):
+    # Items left unacknowledged by a worker that died.
+    recovered = index_queue.recover()
+    if recovered:
+        print("Recovered=%d" % recovered)
+    while True:
+        lag = index_queue.lag()
+        index_queue.record_lag(lag)
+        items = index_queue.pop(batch_size)
+        if not items:
+            if once:
+                break
+            time.sleep(idle)
+            continue
+
+        try:
+            entries = _index_entries(items)
+        except Exception as ex:
+            print(ex)
+            index_queue.requeue(items)
+            index_queue.ack(items)
+            print("Loading failed, requeued=%d lag=%.1fs" % (len(items), lag))
+            time.sleep(backoff)
+            continue
+        finally:
+            db.session.remove()
+
+        for attempt in range(max_retries + 1):
+            es.clear_bulk_queue()
+            es.bulk_queue.extend(entries)
+            try:
+                errors = es.perform_bulk()
+                break
+            except Exception as ex:
+                print(ex)
+                if attempt == max_retries:
+                    errors = None
+                    break
+                time.sleep(backoff * 2 ** attempt)
+
+        if errors is None:
+            index_queue.requeue(items)
+            index_queue.ack(items)
+            print("Bulk failed, requeued=%d lag=%.1fs" % (len(items), lag))
+            continue
+        # Deleting a document that was never indexed is not a failure.
+        errors = [
+            error for error in errors if error.get("delete", {}).get("status") != 404
+        ]
+        retry = _retryable_items(items, errors)
+        index_queue.requeue(retry)
+        index_queue.ack(items)
+        for error in errors:
+            print(error)
+        print(
+            "Indexed=%d failed=%d requeued=%d lag=%.1fs"
+            % (len(entries) - len(errors), len(errors), len(retry), lag)
+        )
+
+
+def _retryable_items(items, errors):
+    """Items whose bulk failure may pass later: rejections and server errors."""
+    failed = set()
+    for error in errors:
+        [(_, result)] = error.items()
+        if result.get("status") == 429 or result.get("status", 0) >= 500:
+            failed.add(str(result.get("_id")))
+    return [item for item in items if str(item[1]) in failed]
+
+
+@mng_cli.command("flush-carts", with_appcontext=True)
+@click.option("--batch-size", default=100, show_default=True)
+@click.option("--interval", default=0.0, help="Keep flushing every N seconds.")
+def flush_carts(batch_size, interval):
+    """Write carts changed in Redis back to carts/cart_lines."""
+    while True:
+        flushed = 0
+        cart_ids = cart_store.dirty(batch_size)
+        while cart_ids:
+            open_ids = {
+                cart_id
+                for cart_id, in db.session.query(models.Cart.id)
+                .filter(models.Cart.id.in_(cart_ids))
+                .filter_by(status=models.Cart.CartStatus.OPEN)
+            }
+            # Closed or missing carts have nothing left to write.
+            cart_store.drop(*(set(cart_ids) - open_ids))
+            for cart_id in open_ids:
+                cart_store.flush(cart_id)
+            try:
+                db.session.commit()
+                flushed += len(open_ids)
+            except Exception as ex:
+                print(ex)
+                db.session.rollback()
+                break
+            cart_ids = cart_store.dirty(batch_size)
+        print("Carts flushed=%d" % flushed)
+        if not interval:
+            break
+        time.sleep(interval)
+
+
+def _hot_queries():
+    Product = models.Product
+    assoc = models.product_and_tag_assoc
+    return {
+        "product by slug": Product.query.filter_by(slug="slug"),
+        "products newest": (
+            Product.query.filter_by(active=True)
+            .order_by(Product.date_created.desc(), Product.id.desc())
+            .limit(11)
+        ),
+        "products by price": (
+            Product.query.filter_by(active=True)
+            .order_by(Product.price.asc(), Product.id.asc())
+            .limit(11)
+        ),
+        "user by email": models.User.query.filter_by(email="user@domain.com"),
+        "open carts of user": models.Cart.query.filter_by(user_id=1).filter_by(
+            status=models.Cart.CartStatus.OPEN
+        ),
+        "cart line by product": models.CartLine.query.filter_by(cart_id=1).filter_by(
+            product_id=1
+        ),
+        "orders of user": models.Order.query.filter_by(user_id=1),
+        "products of tag": db.session.query(assoc.c.product_id).filter(
+            assoc.c.product_tag_id == 1
+        ),
+        "tags of product": db.session.query(assoc.c.product_tag_id).filter(
+            assoc.c.product_id == 1
+        ),
+    }
+
+
+def _full_scans(sql):
+    if db.engine.dialect.name == "sqlite":
+        plan = db.session.execute("EXPLAIN QUERY PLAN " + sql).fetchall()
+        return [
+            row[-1]
+            for row in plan
+            if row[-1].startswith("SCAN") and "INDEX" not in row[-1]
+        ]
+    plan = db.session.execute("EXPLAIN " + sql).fetchall()
+    return [f"{row['table']}: {row['type']}" for row in plan if row["type"] == "ALL"]
+
+
+@mng_cli.command("explain-hot-queries", with_appcontext=True)
+def explain_hot_queries():
+    """Fail when a hot lookup falls back to a full table scan.
+
+    Run it against a database with realistic data, the planner may prefer a
+    scan on nearly empty tables.
+    """
+    failures = 0
+    for name, query in _hot_queries().items():
+        sql = str(
+            query.statement.compile(
+                dialect=db.engine.dialect, compile_kwargs={"literal_binds": True}
+            )
+        )
+        scans = _full_scans(sql)
+        if scans:
+            failures += 1
+            print("FULL SCAN %s: %s" % (name, ", ".join(scans)))
+        else:
+            print("ok %s" % name)
+    if failures:
+        sys.exit("\n%d hot queries fall back to a full scan" % failures)
+
+
+@contextmanager
+def _recorded_statements():
+    statements = list()
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, "before_cursor_execute", record)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, "before_cursor_execute", record)
+
+
+@mng_cli.command("check-query-counts", with_appcontext=True)
+@click.option("--page-sizes", default="5,10,20,40", show_default=True)
+def check_query_counts(page_sizes):
+    """Fail when rendering a page of products takes more queries as it grows.
+
+    Pages are loaded and marshalled through the ProductSchema load plan, as
+    product documents are built. Needs as many products as the largest page.
+    """
+    sizes = sorted(int(size) for size in page_sizes.split(","))
+    product_ids = [
+        product_id
+        for product_id, in db.session.query(models.Product.id)
+        .order_by(models.Product.id)
+        .limit(sizes[-1])
+    ]
+    if len(product_ids) < sizes[-1]:
+        sys.exit("\nNeeds %d products, found %d" % (sizes[-1], len(product_ids)))
+
+    counts = dict()
+    for size in sizes:
+        db.session.remove()
+        with _recorded_statements() as statements:
+            build_product_documents(product_ids[:size])
+        counts[size] = len(statements)
+        print("page of %d: %d queries" % (size, counts[size]))
+    if len(set(counts.values())) > 1:
+        sys.exit("\nThe query count of a page depends on its size")
+
+
+def _interpreted_payload(model_object):
+    # Payloads as they were built before compile_searchable, for comparison.
+    payload = dict()
+    for field in model_object.__searchable__:
+        if isinstance(field, str):
+            payload[field] = getattr(model_object, field)
+            continue
+        field, subfields = field
+        value = getattr(model_object, field)
+        if isinstance(value, list):
+            payload[field] = [
+                {subfield: getattr(item, subfield) for subfield in subfields}
+                for item in value
+            ]
+        elif len(subfields) == 1:
+            payload[field] = getattr(value, subfields[0])
+        else:
+            payload[field] = {
+                subfield: getattr(value, subfield) for subfield in subfields
+            }
+    return payload
+
+
+def _bench_products(start, count, brands, tags):
+    products = list()
+    for number in range(start, start + count):
+        product = models.Product(name=f"Product {number}", price=number % 500)
+        product.id = number + 1
+        product.brand = brands[number % len(brands)]
+        product.tags = [tags[number % len(tags)], tags[number * 7 % len(tags)]]
+        product.images = [
+            models.ProductImage(
+                image_url=f"{number}.jpg", thumbnail_url=f"{number}.thumb.jpg"
+            )
+        ]
+        products.append(product)
+    return products
+
+
+@mng_cli.command("bench-payloads", with_appcontext=True)
+@click.option("--count", default=100000, show_default=True)
+@click.option("--window", default=10000, show_default=True)
+def bench_payloads(count, window):
+    """Time search payloads of products, interpreted and compiled.
+
+    Runs on unsaved products with a brand, two tags and an image each,
+    built ``window`` at a time to bound memory.
+    """
+    brands = [models.ProductBrand(name=f"Brand {number}") for number in range(50)]
+    tags = [models.ProductTag(name=f"Tag {number}") for number in range(20)]
+    compiled = compile_searchable(models.Product)
+    extractors = (("interpreted", _interpreted_payload), ("compiled", compiled))
+    timings = Counter()
+    for start in range(0, count, window):
+        products = _bench_products(start, min(window, count - start), brands, tags)
+        for name, extract in extractors:
+            started = time.perf_counter()
+            for product in products:
+                extract(product)
+            timings[name] += time.perf_counter() - started
+        if any(
+            _interpreted_payload(product) != compiled(product) for product in products
+        ):
+            sys.exit("\nCompiled payloads differ from interpreted ones")
+        for brand in brands:
+            brand.products = []
+        for tag in tags:
+            tag.products = []
+
+    for name, _ in extractors:
+        print(
+            "%s: %.2fs, %.2f us per document"
+            % (name, timings[name], timings[name] / count * 1e6)
+        )
+    print("speedup: %.1fx" % (timings["interpreted"] / timings["compiled"]))
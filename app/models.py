@@ -1,22 +1,191 @@
 from flask import current_app as app
 from flask_sqlalchemy import event
+from sqlalchemy.orm import selectinload
+from redis import RedisError
 from slugify import slugify
 from werkzeug.security import generate_password_hash, check_password_hash
 from cloudinary.uploader import destroy
-from app import db, es
+from app import db, es, index_queue
 import os
 import enum
+import time
+
+
+def _search_targets(obj):
+    """Searchable objects whose document includes ``obj``."""
+    if isinstance(obj, SearchableMixin):
+        return [obj]
+    targets = list()
+    for owner in getattr(obj, "__search_owners__", ()):
+        value = getattr(obj, owner)
+        if isinstance(value, list):
+            targets.extend(value)
+        elif value is not None:
+            targets.append(value)
+    return targets
 
 
 class SearchableMixin(object):
     @classmethod
-    def reindex(cls):
-        if es.object.indices.exists(index=cls.__tablename__):
-            es.object.indices.delete(cls.__tablename__)
-        es.clear_bulk_queue()
-        for obj in cls.query:
-            es.add_to_bulk_queue(cls.__tablename__, obj, "index")
-        es.perform_bulk()
+    def search_query(cls):
+        # Only active objects are indexed. Eager load every relationship the
+        # payload reads.
+        return cls.query.filter_by(active=True).options(
+            *[
+                selectinload(getattr(cls, field[0]))
+                for field in cls.__searchable__
+                if isinstance(field, tuple)
+            ]
+        )
+
+    def search_operation(self):
+        """Bulk operation bringing the index up to date with this object."""
+        return "index" if self.active else "delete"
+
+    @classmethod
+    def searchable_models(cls):
+        return {model.__tablename__: model for model in cls.__subclasses__()}
+
+    @classmethod
+    def iter_search_windows(cls, size):
+        # Keyset windows over the primary key; each window is released
+        # from the session before the next one is read.
+        last_id = 0
+        while True:
+            window = (
+                cls.search_query()
+                .filter(cls.id > last_id)
+                .order_by(cls.id)
+                .limit(size)
+                .all()
+            )
+            if not window:
+                return
+            last_id = window[-1].id
+            yield window
+            db.session.expunge_all()
+
+    @classmethod
+    def search_entries(cls, index, chunk_size):
+        return (
+            es.make_bulk_entry(index, obj, "index")
+            for window in cls.iter_search_windows(chunk_size)
+            for obj in window
+        )
+
+    @classmethod
+    def entries_for_ids(cls, index, object_ids):
+        """Index entries for ``object_ids`` as they are now, else deletes."""
+        entries = list()
+        found = set()
+        for obj in cls.search_query().filter(cls.id.in_(object_ids)):
+            found.add(obj.id)
+            entries.append(es.make_bulk_entry(index, obj, "index"))
+        for object_id in set(object_ids) - found:
+            entries.append(es.make_delete_entry(index, object_id))
+        return entries
+
+    @classmethod
+    def reindex(cls, chunk_size=None, thread_count=None):
+        """Rebuild the index, returning (indexed, failed items, seconds)."""
+        started = time.time()
+        chunk_size = chunk_size or es.chunk_size
+        if es.local:
+            # The database copy is replaced in one transaction.
+            indexed = es.local.rebuild(
+                db.session.connection(),
+                cls.__tablename__,
+                cls.search_entries(cls.__tablename__, chunk_size),
+                chunk_size,
+            )
+            db.session.commit()
+            es.changed()
+            if not es.object:
+                return indexed, [], time.time() - started
+
+        # Searches keep hitting the current version through the alias
+        # until the new one is fully built. Writes meanwhile also land in
+        # the current version and are replayed once the alias moves.
+        alias = cls.__tablename__
+        if es.rebuilds:
+            es.rebuilds.start(alias)
+        try:
+            index = es.create_index_version(alias, cls.__search_index__)
+            entries = cls.search_entries(index, chunk_size)
+            indexed, failed = es.stream_bulk(entries, chunk_size, thread_count)
+            es.publish_index_version(alias, index)
+        finally:
+            written = es.rebuilds.finish(alias) if es.rebuilds else []
+        for start in range(0, len(written), chunk_size):
+            entries = cls.entries_for_ids(alias, written[start : start + chunk_size])
+            _, replay_failed = es.stream_bulk(entries, chunk_size, 1)
+            failed.extend(replay_failed)
+            db.session.expunge_all()
+        if written:
+            es.object.indices.refresh(index=alias)
+            es.changed()
+        return indexed, failed, time.time() - started
+
+    @classmethod
+    def before_commit(cls, session):
+        # Only the documents touched by this commit are sent to the index,
+        # built here while the transaction can still load relationships.
+        if not es.enabled:
+            return
+        pending = dict()
+        for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+            for target in _search_targets(obj):
+                pending.setdefault(id(target), (target.search_operation(), target))
+        for obj in session.deleted:
+            if isinstance(obj, SearchableMixin):
+                pending[id(obj)] = ("delete", obj)
+        if not pending:
+            return
+
+        session.flush()
+        queued = es.object is not None and index_queue.enabled
+        entries = dict()
+        if es.local or not queued:
+            for operation, obj in pending.values():
+                entries[(obj.__tablename__, obj.id)] = es.make_bulk_entry(
+                    obj.__tablename__, obj, operation
+                )
+        if es.local:
+            # The database copy is written in the same transaction.
+            es.local.apply(session.connection(), list(entries.values()))
+            session.info["search_changed"] = True
+        if not es.object:
+            return
+        if queued:
+            # The index worker loads and serializes the objects later.
+            operations = session.info.setdefault("search_operations", dict())
+            for operation, obj in pending.values():
+                operations[(obj.__tablename__, obj.id)] = operation
+            return
+        session.info.setdefault("search_actions", dict()).update(entries)
+
+    @classmethod
+    def after_commit(cls, session):
+        if session.info.pop("search_changed", None):
+            es.changed()
+        operations = session.info.pop("search_operations", None)
+        if operations:
+            try:
+                index_queue.push(
+                    (index, object_id, operation)
+                    for (index, object_id), operation in operations.items()
+                )
+            except RedisError as ex:
+                print(ex)
+        actions = session.info.pop("search_actions", None)
+        if actions:
+            es.bulk_apply(list(actions.values()))
+
+    @classmethod
+    def after_rollback(cls, session):
+        session.info.pop("search_operations", None)
+        session.info.pop("search_actions", None)
+        session.info.pop("search_changed", None)
 
 
 product_and_tag_assoc = db.Table(
@@ -24,6 +193,8 @@ product_and_tag_assoc = db.Table(
     db.metadata,
     db.Column("product_id", db.Integer, db.ForeignKey("products.id")),
     db.Column("product_tag_id", db.Integer, db.ForeignKey("product_tags.id")),
+    db.Index("ix_product_and_tag_assoc_product_tag", "product_id", "product_tag_id"),
+    db.Index("ix_product_and_tag_assoc_tag_product", "product_tag_id", "product_id"),
 )
 
 product_and_feature_assoc = db.Table(
@@ -31,12 +202,28 @@ product_and_feature_assoc = db.Table(
     db.metadata,
     db.Column("product_id", db.Integer, db.ForeignKey("products.id")),
     db.Column("product_feature_id", db.Integer, db.ForeignKey("product_features.id")),
+    db.Index(
+        "ix_product_and_feature_assoc_product_feature",
+        "product_id",
+        "product_feature_id",
+    ),
+    db.Index(
+        "ix_product_and_feature_assoc_feature_product",
+        "product_feature_id",
+        "product_id",
+    ),
 )
 
 
 class Product(db.Model, SearchableMixin):
     __tablename__ = "products"
+    __table_args__ = (
+        db.Index("ix_products_slug", "slug", unique=True),
+        db.Index("ix_products_active_date_created", "active", "date_created"),
+        db.Index("ix_products_active_price", "active", "price"),
+    )
     __searchable__ = (
+        "id",
         "name",
         "slug",
         "price",
@@ -44,6 +231,56 @@ class Product(db.Model, SearchableMixin):
         ("tags", ("name",)),
         ("images", ("image_url", "thumbnail_url", "main",)),
     )
+    __search_index__ = {
+        "settings": {
+            "analysis": {
+                "analyzer": {
+                    "product_text": {
+                        "type": "custom",
+                        "tokenizer": "standard",
+                        "filter": ["lowercase", "asciifolding"],
+                    }
+                }
+            }
+        },
+        "mappings": {
+            "dynamic": False,
+            "properties": {
+                "id": {"type": "long"},
+                "name": {
+                    "type": "text",
+                    "analyzer": "product_text",
+                    "fields": {
+                        "keyword": {"type": "keyword", "ignore_above": 256},
+                        "suggest": {"type": "completion", "analyzer": "product_text"},
+                    },
+                },
+                "slug": {"type": "keyword"},
+                "price": {"type": "scaled_float", "scaling_factor": 100},
+                "brand": {
+                    "type": "keyword",
+                    "fields": {"text": {"type": "text", "analyzer": "product_text"}},
+                },
+                "tags": {
+                    "properties": {
+                        "name": {
+                            "type": "keyword",
+                            "fields": {
+                                "text": {"type": "text", "analyzer": "product_text"}
+                            },
+                        }
+                    }
+                },
+                "images": {"type": "object", "enabled": False},
+            },
+        },
+    }
+    __search_fields__ = ("name^3", "brand.text^2", "tags.name.text")
+    __search_facets__ = {
+        "brand": {"terms": {"field": "brand", "size": 50}},
+        "tags": {"terms": {"field": "tags.name", "size": 50}},
+        "price": {"histogram": {"field": "price", "interval": 50, "min_doc_count": 1}},
+    }
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(64), nullable=False)
@@ -71,6 +308,9 @@ class Product(db.Model, SearchableMixin):
     )
     cartlines = db.relationship("CartLine", lazy=True, cascade="all, delete-orphan")
     orderlines = db.relationship("OrderLine", lazy=True, cascade="all, delete-orphan")
+    document = db.relationship(
+        "ProductDocument", uselist=False, lazy=True, cascade="all, delete-orphan"
+    )
 
     def __init__(self, **kwargs):
         self.name = kwargs.get("name")
@@ -82,6 +322,39 @@ class Product(db.Model, SearchableMixin):
         return self.name
 
 
+class ProductDocument(db.Model):
+    """Fully rendered ProductSchema JSON, rebuilt on every catalog write."""
+
+    __tablename__ = "product_documents"
+
+    product_id = db.Column(
+        db.Integer, db.ForeignKey("products.id", ondelete="CASCADE"), primary_key=True,
+    )
+    document = db.Column(db.Text, nullable=False)
+    date_updated = db.Column(db.DateTime)
+
+
+class SearchDocument(db.Model):
+    """Database copy of a search index document, see DatabaseSearch."""
+
+    __tablename__ = "search_documents"
+    __table_args__ = (
+        db.Index(
+            "ix_search_documents_index_name_object_id",
+            "index_name",
+            "object_id",
+            unique=True,
+        ),
+        db.Index("ix_search_documents_content", "content", mysql_prefix="FULLTEXT"),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    index_name = db.Column(db.String(64), nullable=False)
+    object_id = db.Column(db.Integer, nullable=False)
+    content = db.Column(db.Text, nullable=False)
+    payload = db.Column(db.Text, nullable=False)
+
+
 class ProductSpecifications(db.Model):
     __tablename__ = "product_specifications"
 
@@ -100,6 +373,7 @@ class ProductSpecifications(db.Model):
 
 class ProductTag(db.Model):
     __tablename__ = "product_tags"
+    __search_owners__ = ("products",)
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(32), nullable=False)
@@ -116,6 +390,7 @@ class ProductTag(db.Model):
 
 class ProductImage(db.Model):
     __tablename__ = "product_images"
+    __search_owners__ = ("product",)
 
     id = db.Column(db.Integer, primary_key=True)
     public_id = db.Column(db.String(50), nullable=False)
@@ -140,6 +415,7 @@ class ProductFeature(db.Model):
 
 class ProductBrand(db.Model):
     __tablename__ = "product_brands"
+    __search_owners__ = ("products",)
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(64), nullable=False)
@@ -156,6 +432,7 @@ class ProductBrand(db.Model):
 
 class User(db.Model):
     __tablename__ = "users"
+    __table_args__ = (db.Index("ix_users_email", "email", unique=True),)
 
     id = db.Column(db.Integer, primary_key=True)
     first_name = db.Column(db.String(32))
@@ -193,6 +470,7 @@ class User(db.Model):
 
 class Cart(db.Model):
     __tablename__ = "carts"
+    __table_args__ = (db.Index("ix_carts_user_id_status", "user_id", "status"),)
 
     class CartStatus(enum.Enum):
         OPEN = "OPEN"
@@ -209,6 +487,11 @@ class Cart(db.Model):
 
 class CartLine(db.Model):
     __tablename__ = "cart_lines"
+    __table_args__ = (
+        db.Index(
+            "uq_cart_lines_cart_id_product_id", "cart_id", "product_id", unique=True
+        ),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     quantity = db.Column(db.Integer, nullable=False, default=1)
@@ -219,6 +502,7 @@ class CartLine(db.Model):
 
 class Order(db.Model):
     __tablename__ = "orders"
+    __table_args__ = (db.Index("ix_orders_user_id", "user_id"),)
 
     class OrderStatus(enum.Enum):
         NEW = "NEW"
@@ -253,3 +537,8 @@ class OrderLine(db.Model):
     product_id = db.Column(db.Integer, db.ForeignKey("products.id"))
     product = db.relationship("Product")
     order_id = db.Column(db.Integer, db.ForeignKey("orders.id"))
+
+
+event.listen(db.session, "before_commit", SearchableMixin.before_commit)
+event.listen(db.session, "after_commit", SearchableMixin.after_commit)
+event.listen(db.session, "after_rollback", SearchableMixin.after_rollback)
@@ -5,3 +5,16 @@ api_blueprint = Blueprint("api", __name__, url_prefix="/api")
 """ Shared constant for resources """
 NOT_FOUND_ERROR = "{} not found."
 INTERNAL_ERROR = "Internal server error."
+
+""" Load plans """
+# Loader options keyed by response schema name. Every relationship a schema
+# marshals has to be covered here, anything else raises instead of lazy loading.
+LOAD_PLANS = dict()
+
+
+def register_load_plan(schema, *options):
+    LOAD_PLANS[schema.name] = options
+
+
+def load_plan(schema):
+    return LOAD_PLANS.get(schema.name, ())
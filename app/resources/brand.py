@@ -1,6 +1,7 @@
 from flask_restplus import Resource, fields
-from app.models import ProductBrand as BrandModel
-from app import api
+from sqlalchemy import and_, func, true
+from app.models import ProductBrand as BrandModel, Product as ProductModel
+from app import api, db, response_cache, versions
 from . import INTERNAL_ERROR
 
 brand_ns = api.namespace("brands", description="Brand API")
@@ -14,12 +15,31 @@ BrandSchema = brand_ns.model(
 @brand_ns.route("")
 class Brand(Resource):
     @classmethod
+    @versions.conditional(BrandModel.__tablename__, ProductModel.__tablename__)
+    @response_cache.cached("brands")
     @brand_ns.doc("list_brands")
     @brand_ns.marshal_list_with(BrandSchema, envelope="brand_list")
     def get(cls):
         try:
-            brands = BrandModel.query.all()
+            # Active product counts come from the same grouped query.
+            rows = (
+                db.session.query(BrandModel, func.count(ProductModel.id))
+                .outerjoin(
+                    ProductModel,
+                    and_(
+                        ProductModel.brand_id == BrandModel.id,
+                        ProductModel.active == true(),
+                    ),
+                )
+                .group_by(BrandModel.id)
+                .all()
+            )
         except Exception as ex:
             print(ex)
             return {"message": INTERNAL_ERROR}, 500
+        response_cache.tag(*(f"brand:{brand.id}" for brand, _ in rows))
+        brands = [
+            {"name": brand.name, "slug": brand.slug, "total_products": total}
+            for brand, total in rows
+        ]
         return brands, 200
@@ -1,11 +1,40 @@
-from flask_restplus import Resource, reqparse, fields
-from app import api, models, db
+from flask_restplus import Resource, reqparse, fields, marshal
+from sqlalchemy import text, func
+from sqlalchemy.orm import joinedload, selectinload
+from app import api, models, db, versions
+from app.catalog import PRODUCT_TABLES
+from app.cart_store import (
+    add_line_quantities,
+    cart_store,
+    read_cart_lines,
+    save_cart_lines,
+)
 from . import NOT_FOUND_ERROR
 from app.utils import get_or_create
 import ast
 
 """ Constants """
 RESOURCE_NAME = "Cart"
+CART_VERSION = "cart:{}"
+CART_SUMMARY_KEY = "cart-summary:{}"
+CART_OPERATIONS = ["add", "set", "remove"]
+INVALID_QUANTITY = "add takes a positive quantity, set zero or more."
+# Add one of a product to a cart, or create the line, in one statement.
+# Nothing is inserted when the cart or the product does not exist.
+ADD_TO_CART_SQL = {
+    "mysql": """
+        INSERT INTO cart_lines (cart_id, product_id, quantity)
+        SELECT carts.id, products.id, 1 FROM carts, products
+        WHERE carts.id = :cart_id AND products.id = :product_id
+        ON DUPLICATE KEY UPDATE cart_lines.quantity = cart_lines.quantity + 1
+    """,
+    "sqlite": """
+        INSERT INTO cart_lines (cart_id, product_id, quantity)
+        SELECT carts.id, products.id, 1 FROM carts, products
+        WHERE carts.id = :cart_id AND products.id = :product_id
+        ON CONFLICT (cart_id, product_id) DO UPDATE SET quantity = quantity + 1
+    """,
+}
 
 """ Cart Request Parsers """
 # _cart_parser = reqparse.RequestParser()
@@ -81,9 +110,21 @@ CartSchema = api.model(
                             },
                         )
                     ),
+                    "extended_price": fields.Fixed(decimals=2),
                 },
             )
         ),
+        "item_count": fields.Integer,
+        "subtotal": fields.Fixed(decimals=2),
+    },
+)
+
+CartSummarySchema = api.model(
+    "CartSummarySchema",
+    {
+        "id": fields.Integer,
+        "item_count": fields.Integer,
+        "subtotal": fields.Fixed(decimals=2),
     },
 )
 
@@ -285,6 +326,7 @@ class CartCreate(Resource):
         except Exception as ex:
             db.session.rollback()
             return api.abort(500, ex)
+        versions.bump(CART_VERSION.format(new_cart.id))
         return {"cart_id": new_cart.id}, 200
 
 
@@ -294,6 +336,156 @@ _merge_carts_parser.add_argument("to_cart_id", required=False, type=int)
 _merge_carts_parser.add_argument("user_id", required=True, type=int)
 
 
+""" Cart rendering helpers """
+
+
+def _cart_query():
+    # Lines with their products, brands and images in three queries.
+    product = selectinload(models.Cart.cart_lines).joinedload(models.CartLine.product)
+    return models.Cart.query.options(
+        product.joinedload(models.Product.brand),
+        product.selectinload(models.Product.images),
+    )
+
+
+def _cart_totals(cart_id):
+    """Item count and subtotal of an open cart in one aggregate query.
+
+    None when there is no such cart.
+    """
+    totals = (
+        db.session.query(
+            func.coalesce(func.sum(models.CartLine.quantity), 0),
+            func.coalesce(func.sum(models.CartLine.quantity * models.Product.price), 0),
+        )
+        .select_from(models.Cart)
+        .outerjoin(models.CartLine, models.CartLine.cart_id == models.Cart.id)
+        .outerjoin(models.Product, models.Product.id == models.CartLine.product_id)
+        .filter(models.Cart.id == cart_id)
+        .filter(models.Cart.status == models.Cart.CartStatus.OPEN)
+        .group_by(models.Cart.id)
+        .first()
+    )
+    if totals is None:
+        return None
+    item_count, subtotal = totals
+    return {"item_count": int(item_count), "subtotal": subtotal}
+
+
+def _line(line_id, quantity, product):
+    return {
+        "id": line_id,
+        "quantity": quantity,
+        "product": product,
+        "extended_price": quantity * product.price if product else None,
+    }
+
+
+def _cart_response(cart):
+    # A cart from _cart_query, with its totals.
+    return dict(
+        _cart_totals(cart.id) or {"item_count": 0, "subtotal": 0},
+        id=cart.id,
+        status=cart.status,
+        cart_lines=[
+            _line(line.id, line.quantity, line.product) for line in cart.cart_lines
+        ],
+    )
+
+
+def _line_products(product_ids):
+    return {
+        product.id: product
+        for product in models.Product.query.options(
+            joinedload(models.Product.brand), selectinload(models.Product.images)
+        ).filter(models.Product.id.in_(product_ids))
+    }
+
+
+def _stored_lines(quantities):
+    # Lines of a Redis cart, with the product id as line id.
+    products = _line_products(list(quantities))
+    return [
+        _line(product_id, quantity, products.get(product_id))
+        for product_id, quantity in sorted(quantities.items())
+    ]
+
+
+def _stored_cart(cart_id):
+    quantities = cart_store.lines(cart_id)
+    if quantities is None:
+        return None
+    lines = _stored_lines(quantities)
+    return {
+        "id": cart_id,
+        "status": models.Cart.CartStatus.OPEN,
+        "cart_lines": lines,
+        "item_count": sum(quantities.values()),
+        "subtotal": sum(line["extended_price"] or 0 for line in lines),
+    }
+
+
+def _cart_summary(cart_id):
+    """Marshalled CartSummarySchema of an open cart, None without one."""
+    if cart_store.enabled:
+        quantities = cart_store.lines(cart_id)
+        if quantities is None:
+            return None
+        prices = dict(
+            db.session.query(models.Product.id, models.Product.price).filter(
+                models.Product.id.in_(list(quantities))
+            )
+        )
+        totals = {
+            "item_count": sum(quantities.values()),
+            "subtotal": sum(
+                quantity * prices.get(product_id, 0)
+                for product_id, quantity in quantities.items()
+            ),
+        }
+    else:
+        totals = _cart_totals(cart_id)
+        if totals is None:
+            return None
+    return marshal(dict(totals, id=cart_id), CartSummarySchema)
+
+
+def _merge_lines(from_cart_id, to_cart_id):
+    """Fold the lines of one cart into another in a fixed number of queries.
+
+    Lines of both carts are read and locked at once. Source lines for
+    products the target already has are deleted and their quantities added
+    to the target lines with one CASE update, relative to the stored
+    quantity so concurrent adds are kept. The other source lines move over
+    with one set-based update, keeping their ids.
+    """
+    CartLine = models.CartLine
+    lines = (
+        db.session.query(
+            CartLine.id, CartLine.cart_id, CartLine.product_id, CartLine.quantity
+        )
+        .filter(CartLine.cart_id.in_([from_cart_id, to_cart_id]))
+        .with_for_update()
+        .all()
+    )
+    target = {line.product_id: line for line in lines if line.cart_id == to_cart_id}
+    duplicates = [
+        line
+        for line in lines
+        if line.cart_id == from_cart_id and line.product_id in target
+    ]
+    if duplicates:
+        CartLine.query.filter(CartLine.id.in_([line.id for line in duplicates])).delete(
+            synchronize_session=False
+        )
+    CartLine.query.filter(CartLine.cart_id == from_cart_id).update(
+        {CartLine.cart_id: to_cart_id}, synchronize_session=False
+    )
+    add_line_quantities(
+        {target[line.product_id].id: line.quantity for line in duplicates}
+    )
+
+
 @cart_ns.route("/merge")
 class CartMerge(Resource):
     @classmethod
@@ -303,16 +495,18 @@ class CartMerge(Resource):
         from_cart_id = data.get("from_cart_id")
         to_cart_id = data.get("to_cart_id")
         user_id = data.get("user_id")
-        from_cart = (
-            models.Cart.query.filter_by(status=models.Cart.CartStatus.OPEN)
-            .filter_by(id=from_cart_id)
-            .first()
-        )
-        to_cart = (
-            models.Cart.query.filter_by(status=models.Cart.CartStatus.OPEN)
-            .filter_by(id=to_cart_id)
-            .first()
-        )
+        # Both carts are locked, in id order, until the merge commits.
+        carts = {
+            cart.id: cart
+            for cart in models.Cart.query.filter(
+                models.Cart.id.in_([from_cart_id, to_cart_id or from_cart_id])
+            )
+            .filter_by(status=models.Cart.CartStatus.OPEN)
+            .order_by(models.Cart.id)
+            .with_for_update()
+        }
+        from_cart = carts.get(from_cart_id)
+        to_cart = carts.get(to_cart_id) if to_cart_id != from_cart_id else None
         user = models.User.query.filter_by(id=user_id).filter_by(active=True).first()
 
         if not from_cart:
@@ -321,30 +515,30 @@ class CartMerge(Resource):
         if not user:
             return api.abort(404, NOT_FOUND_ERROR.format(f"User {user_id}"))
 
-        if not to_cart:
+        merged = to_cart is not None
+        if not merged:
             to_cart = from_cart
             to_cart.user = user
             db.session.add(to_cart)
         else:
-            for line in from_cart.cart_lines:
-                final_cart_line = (
-                    models.CartLine.query.filter_by(cart_id=to_cart_id)
-                    .filter_by(product_id=line.product_id)
-                    .first()
-                )
-                if not final_cart_line:
-                    final_cart_line = line
-                    final_cart_line.cart = to_cart
-                else:
-                    final_cart_line.quantity += line.quantity
-                db.session.add(final_cart_line)
+            if cart_store.enabled:
+                cart_store.flush(from_cart.id)
+                cart_store.flush(to_cart.id)
+            _merge_lines(from_cart.id, to_cart.id)
 
         try:
             db.session.commit()
         except Exception as ex:
             db.session.rollback()
             return api.abort(500, ex)
-        return to_cart, 200
+        versions.bump(
+            CART_VERSION.format(from_cart_id), CART_VERSION.format(to_cart.id)
+        )
+        if cart_store.enabled:
+            if merged:
+                cart_store.drop(from_cart_id, to_cart.id)
+            return _stored_cart(to_cart.id), 200
+        return _cart_response(_cart_query().filter_by(id=to_cart.id).one()), 200
 
 
 _add_to_cart_parser = reqparse.RequestParser()
@@ -363,44 +557,72 @@ class CartLineOperations(Resource):
     @classmethod
     @cart_ns.marshal_with(CartlineSchema, envelope="cartline")
     def patch(cls, id):
-        cart = models.Cart.query.get(id)
         data = _add_to_cart_parser.parse_args()
         product_id = data["product_id"]
-        if not cart:
-            return api.report(404, NOT_FOUND_ERROR.format(f"Cart {id}"))
 
-        cartline = (
-            models.CartLine.query.filter_by(cart_id=id)
-            .filter_by(product_id=product_id)
-            .first()
-        )
-        if cartline:
-            cartline.quantity += 1
-        else:
-            product = models.Product.query.get(product_id)
+        if cart_store.enabled:
+            product = _line_products([product_id]).get(product_id)
             if not product:
                 return api.abort(404, NOT_FOUND_ERROR.format(f"Product {product_id}"))
-            cartline = models.CartLine()
-            cartline.product = product
-            cartline.cart = cart
-            cartline.quantity = 1
+            quantity = cart_store.add(id, product_id)
+            if quantity is None:
+                return api.abort(404, NOT_FOUND_ERROR.format(f"Cart {id}"))
+            versions.bump(CART_VERSION.format(id))
+            return {"id": product_id, "quantity": quantity, "product": product}, 200
+
         try:
-            db.session.add(cart)
-            db.session.commit()
+            result = db.session.execute(
+                text(ADD_TO_CART_SQL[db.session.get_bind().dialect.name]),
+                {"cart_id": id, "product_id": product_id},
+            )
+            cartline = None
+            if result.rowcount:
+                # Read back by its unique key, in the same transaction.
+                product = joinedload(models.CartLine.product)
+                cartline = (
+                    models.CartLine.query.options(
+                        product.joinedload(models.Product.brand),
+                        product.selectinload(models.Product.images),
+                    )
+                    .filter_by(cart_id=id, product_id=product_id)
+                    .one()
+                )
+                cartline = marshal(cartline, CartlineSchema)
+                db.session.commit()
+            else:
+                db.session.rollback()
         except Exception as ex:
             db.session.rollback()
             print(ex)
             return api.abort(500, ex)
+
+        if not cartline:
+            if not models.Cart.query.get(id):
+                return api.abort(404, NOT_FOUND_ERROR.format(f"Cart {id}"))
+            return api.abort(404, NOT_FOUND_ERROR.format(f"Product {product_id}"))
+        versions.bump(CART_VERSION.format(id))
         return cartline, 200
 
     @classmethod
     @cart_ns.marshal_with(CartlineSchema, envelope="cartline")
     def put(cls, id):
-        cart = models.Cart.query.get(id)
         data = _update_cart_parser.parse_args()
         cartline_id = data["cartline_id"]
         quantity = data["quantity"]
 
+        if cart_store.enabled:
+            if quantity <= 0:
+                return api.abort(400, "0 or negative quantity is not allowed")
+            updated = cart_store.set(id, cartline_id, quantity)
+            if updated is None:
+                return api.abort(404, NOT_FOUND_ERROR.format(f"Cart {id}"))
+            if not updated:
+                return api.abort(404, NOT_FOUND_ERROR.format(f"Cartline {cartline_id}"))
+            versions.bump(CART_VERSION.format(id))
+            return _stored_lines({cartline_id: quantity})[0], 200
+
+        cart = models.Cart.query.get(id)
+
         if not cart:
             return api.abort(404, NOT_FOUND_ERROR.format(f"Cart {id}"))
         cartline = (
@@ -420,14 +642,25 @@ class CartLineOperations(Resource):
             db.session.rollback()
             print(ex)
             return api.abort(500, ex)
+        versions.bump(CART_VERSION.format(id))
         return cartline, 200
 
     @classmethod
     def delete(cls, id):
-        cart = models.Cart.query.get(id)
         data = _delete_cart_parser.parse_args()
         cartline_id = data["cartline_id"]
 
+        if cart_store.enabled:
+            removed = cart_store.remove(id, cartline_id)
+            if removed is None:
+                return api.abort(404, NOT_FOUND_ERROR.format(f"Cart {id}"))
+            if not removed:
+                return api.abort(404, NOT_FOUND_ERROR.format(f"Cartline {cartline_id}"))
+            versions.bump(CART_VERSION.format(id))
+            return {"cartline_id": cartline_id}, 200
+
+        cart = models.Cart.query.get(id)
+
         if not cart:
             return api.abort(404, NOT_FOUND_ERROR.format(f"Cart {id}"))
         cartline = (
@@ -444,18 +677,149 @@ class CartLineOperations(Resource):
             db.session.rollback()
             print(ex)
             return api.abort(500, ex)
+        versions.bump(CART_VERSION.format(id))
         return {"cartline_id": cartline_id}, 200
 
     @classmethod
+    # Lines render product names, prices and images too.
+    @versions.conditional(lambda id: CART_VERSION.format(id), *PRODUCT_TABLES)
     @cart_ns.marshal_with(CartSchema, envelope="cart")
     def get(cls, id):
+        if cart_store.enabled:
+            cart = _stored_cart(id)
+            if not cart:
+                return api.abort(404, NOT_FOUND_ERROR.format(f"Cart {id}"))
+            return cart, 200
+
         # cart = models.Cart.query.get(id)
         cart = (
-            models.Cart.query.filter_by(id=id)
+            _cart_query()
+            .filter_by(id=id)
             .filter_by(status=models.Cart.CartStatus.OPEN)
             .first()
         )
 
         if not cart:
             return api.abort(404, NOT_FOUND_ERROR.format(f"Cart {id}"))
-        return cart, 200
+        return _cart_response(cart), 200
+
+
+""" Cart Summary Resource """
+
+
+@cart_ns.route("/<int:id>/summary")
+class CartSummary(Resource):
+    @classmethod
+    @versions.conditional(lambda id: CART_VERSION.format(id), *PRODUCT_TABLES)
+    @cart_ns.doc("get_cart_summary")
+    @cart_ns.response(404, NOT_FOUND_ERROR.format(RESOURCE_NAME))
+    @cart_ns.marshal_with(CartSummarySchema, envelope="cart_summary")
+    def get(cls, id):
+        # Kept until the cart or a price moves, so badge polling is
+        # answered from Redis without SQL.
+        summary = versions.memoize(
+            (CART_VERSION.format(id), *PRODUCT_TABLES),
+            CART_SUMMARY_KEY.format(id),
+            lambda: _cart_summary(id),
+        )
+        if not summary:
+            return api.abort(404, NOT_FOUND_ERROR.format(f"Cart {id}"))
+        return summary, 200
+
+
+""" Cart Batch Resource """
+
+CartOperationSchema = cart_ns.model(
+    "CartOperationSchema",
+    {
+        "op": fields.String(required=True, enum=CART_OPERATIONS),
+        "product_id": fields.Integer(required=True),
+        "quantity": fields.Integer(description="add: 1 by default, set: 0 removes"),
+    },
+)
+
+CartBatchSchema = cart_ns.model(
+    "CartBatchSchema",
+    {"operations": fields.List(fields.Nested(CartOperationSchema), required=True)},
+)
+
+
+def _parse_operations(payload):
+    """``(op, product_id, quantity)`` tuples, None if a quantity is invalid."""
+    operations = list()
+    for operation in payload:
+        op, quantity = operation["op"], operation.get("quantity")
+        if op == "add":
+            quantity = 1 if quantity is None else quantity
+            if quantity <= 0:
+                return None
+        elif op == "set":
+            if quantity is None or quantity < 0:
+                return None
+        else:
+            quantity = 0
+        operations.append((op, operation["product_id"], quantity))
+    return operations
+
+
+def _apply_operations(quantities, operations):
+    for op, product_id, quantity in operations:
+        if op == "add":
+            quantities[product_id] = quantities.get(product_id, 0) + quantity
+        elif op == "set" and quantity:
+            quantities[product_id] = quantity
+        else:
+            quantities.pop(product_id, None)
+    return quantities
+
+
+@cart_ns.route("/<int:id>/batch")
+class CartBatch(Resource):
+    @classmethod
+    @cart_ns.doc("batch_update_cart")
+    @cart_ns.expect(CartBatchSchema)
+    @cart_ns.response(400, INVALID_QUANTITY)
+    @cart_ns.marshal_with(CartSchema, envelope="cart")
+    def post(cls, id):
+        operations = _parse_operations(api.payload["operations"])
+        if operations is None:
+            return api.abort(400, INVALID_QUANTITY)
+
+        # Every product that may end up in the cart, checked at once.
+        product_ids = {product_id for op, product_id, _ in operations if op != "remove"}
+        if product_ids:
+            found = {
+                product_id
+                for product_id, in db.session.query(models.Product.id).filter(
+                    models.Product.id.in_(product_ids)
+                )
+            }
+            missing = sorted(product_ids - found)
+            if missing:
+                return api.abort(404, NOT_FOUND_ERROR.format(f"Product {missing[0]}"))
+
+        if cart_store.enabled:
+            if not cart_store.apply(id, operations):
+                return api.abort(404, NOT_FOUND_ERROR.format(f"Cart {id}"))
+            versions.bump(CART_VERSION.format(id))
+            return _stored_cart(id), 200
+
+        cart = (
+            models.Cart.query.filter_by(id=id)
+            .filter_by(status=models.Cart.CartStatus.OPEN)
+            .with_for_update()
+            .first()
+        )
+        if not cart:
+            return api.abort(404, NOT_FOUND_ERROR.format(f"Cart {id}"))
+        lines = read_cart_lines(id)
+        quantities = {product_id: quantity for _, product_id, quantity in lines}
+        save_cart_lines(id, _apply_operations(quantities, operations), lines)
+        try:
+            db.session.commit()
+        except Exception as ex:
+            db.session.rollback()
+            print(ex)
+            return api.abort(500, ex)
+        versions.bump(CART_VERSION.format(id))
+        return _cart_response(_cart_query().filter_by(id=id).one()), 200
@@ -1,6 +1,8 @@
 from flask_restplus import Resource, fields
-from app import api, models, db
+from app import api, models, db, versions
 from datetime import datetime
+from app.cart_store import cart_store
+from .cart import CART_VERSION
 
 """ Constants """
 RESOURCE_NAME = "Order"
@@ -43,6 +45,8 @@ class OrderCreate(Resource):
         new_order = models.Order()
         if data["cart_id"] > 0:
             cart_id = data["cart_id"]
+            if cart_store.enabled:
+                cart_store.flush(cart_id)
             cart = models.Cart.query.get(cart_id)
             if cart:
                 for cartline in cart.cart_lines:
@@ -81,4 +85,7 @@ class OrderCreate(Resource):
         except Exception as ex:
             db.session.rollback()
             return api.abort(500, ex)
+        if cart_store.enabled:
+            cart_store.drop(cart.id)
+        versions.bump(CART_VERSION.format(cart.id))
         return {"order_id": new_order.id}, 200
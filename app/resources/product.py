@@ -1,22 +1,45 @@
-from flask_restplus import Resource, reqparse, fields
-from app import api
+from flask_restplus import Resource, reqparse, fields, inputs
+from sqlalchemy import and_, or_, cast, Numeric
+from sqlalchemy.orm import joinedload, selectinload, raiseload
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from app import api, es, response_cache, versions
+from app.catalog import product_tags, load_product_documents, PRODUCT_TABLES
+from app.tag_index import tag_index
+from app.suggest_index import suggest_index
 from app.models import (
     Product as ProductModel,
-    ProductTag as TagModel,
-    product_and_tag_assoc as ProductTagAssoc,
+    ProductDocument as DocumentModel,
 )
-from . import NOT_FOUND_ERROR
+from app.utils import encode_cursor, decode_cursor, price_cents
+from . import NOT_FOUND_ERROR, register_load_plan
 
 """ Constants """
 RESOURCE_NAME = "Product"
+INVALID_CURSOR = "Invalid cursor."
+# sort name -> (keyset column, descending)
+PRODUCT_SORTS = {
+    "newest": (ProductModel.date_created, True),
+    "price": (ProductModel.price, False),
+}
+# Exact type the price keyset is compared as, see price_cents.
+PRICE_KEY_TYPE = Numeric(10, 2)
 
 """ Pagination parser """
 _products_parser = reqparse.RequestParser()
-_products_parser.add_argument("page", type=int, required=False)
+_products_parser.add_argument("page", type=inputs.positive, required=False)
 _products_parser.add_argument(
     "per_page", type=int, required=False, choices=[5, 10, 20, 30, 40], default=10
 )
 _products_parser.add_argument("tags", action="append", required=False)
+_products_parser.add_argument(
+    "tag_mode", required=False, choices=["any", "all"], default="any"
+)
+_products_parser.add_argument("in_stock", type=inputs.boolean, required=False)
+_products_parser.add_argument("cursor", required=False)
+_products_parser.add_argument(
+    "sort", required=False, choices=list(PRODUCT_SORTS), default="newest"
+)
 
 """ Product response model """
 ProductSchema = api.model(
@@ -73,44 +96,335 @@ ProductSchema = api.model(
     },
 )
 
+register_load_plan(
+    ProductSchema,
+    joinedload(ProductModel.brand),
+    joinedload(ProductModel.specifications),
+    selectinload(ProductModel.features),
+    selectinload(ProductModel.tags),
+    selectinload(ProductModel.images),
+    raiseload("*"),
+)
+
+""" Search parser """
+_search_parser = reqparse.RequestParser()
+_search_parser.add_argument("q", required=True)
+_search_parser.add_argument("page", type=inputs.positive, required=False)
+_search_parser.add_argument("cursor", required=False)
+_search_parser.add_argument(
+    "per_page", type=int, required=False, choices=[5, 10, 20, 30, 40], default=10
+)
+_search_parser.add_argument("brand", action="append", required=False)
+_search_parser.add_argument("tag", action="append", required=False)
+_search_parser.add_argument("price_min", type=float, required=False)
+_search_parser.add_argument("price_max", type=float, required=False)
+
+""" Suggest parser """
+_suggest_parser = reqparse.RequestParser()
+_suggest_parser.add_argument("q", required=True)
+_suggest_parser.add_argument(
+    "limit", type=int, required=False, choices=[5, 10, 20], default=10
+)
+
+ProductPageSchema = api.model(
+    "ProductPageSchema",
+    {
+        "product_list": fields.List(fields.Nested(ProductSchema)),
+        "next_cursor": fields.String,
+        "tag_facets": fields.List(
+            fields.Nested(
+                api.model(
+                    "ProductPage_TagFacetSchema",
+                    {"slug": fields.String, "count": fields.Integer},
+                )
+            )
+        ),
+    },
+)
+
+FacetBucketSchema = api.model(
+    "FacetBucketSchema", {"key": fields.Raw, "count": fields.Integer}
+)
+
+ProductSearchSchema = api.model(
+    "ProductSearchSchema",
+    {
+        "product_list": fields.List(fields.Nested(ProductSchema)),
+        "total": fields.Integer,
+        "next_cursor": fields.String,
+        "facets": fields.Nested(
+            api.model(
+                "ProductSearch_FacetsSchema",
+                {
+                    name: fields.List(fields.Nested(FacetBucketSchema))
+                    for name in ProductModel.__search_facets__
+                },
+            )
+        ),
+    },
+)
+
+SuggestionSchema = api.model(
+    "SuggestionSchema",
+    {"kind": fields.String, "name": fields.String, "slug": fields.String},
+)
+
 """ Create Namespace """
 products_ns = api.namespace("products", description="Products API")
 product_ns = api.namespace("product", description="Product API")
 
+
+""" Read model helpers """
+
+
+def _document_query(query):
+    # One row per product: the keyset columns plus its rendered document.
+    return query.with_entities(
+        ProductModel.id,
+        ProductModel.brand_id,
+        ProductModel.date_created,
+        ProductModel.price,
+        DocumentModel.document,
+    ).outerjoin(DocumentModel, DocumentModel.product_id == ProductModel.id)
+
+
+""" Keyset pagination helpers """
+
+
+def _keyset_column(sort):
+    column, descending = PRODUCT_SORTS[sort]
+    if column.key == "price":
+        return cast(column, PRICE_KEY_TYPE), descending
+    return column, descending
+
+
+def _order_by(sort):
+    column, descending = _keyset_column(sort)
+    if descending:
+        return column.desc(), ProductModel.id.desc()
+    return column.asc(), ProductModel.id.asc()
+
+
+def _after_cursor(sort, value, last_id):
+    column, descending = _keyset_column(sort)
+    if not descending:
+        return or_(column > value, and_(column == value, ProductModel.id > last_id))
+    # NULLs sort last on a descending key, so they come after every value.
+    if value is None:
+        return and_(column.is_(None), ProductModel.id < last_id)
+    return or_(
+        column < value,
+        and_(column == value, ProductModel.id < last_id),
+        column.is_(None),
+    )
+
+
+def _cursor_for(sort, product):
+    column, descending = PRODUCT_SORTS[sort]
+    value = getattr(product, column.key)
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    elif column.key == "price":
+        value = str(price_cents(value))
+    return encode_cursor({"sort": sort, "value": value, "id": product.id})
+
+
+def _parse_cursor(cursor):
+    values = decode_cursor(cursor)
+    if not isinstance(values, dict) or values.get("sort") not in PRODUCT_SORTS:
+        return None
+    sort, value = values["sort"], values.get("value")
+    key = PRODUCT_SORTS[sort][0].key
+    try:
+        if value is not None and key == "date_created":
+            value = datetime.fromisoformat(value)
+        elif key == "price":
+            value = Decimal(value)
+        return sort, value, int(values["id"])
+    except (KeyError, TypeError, ValueError, InvalidOperation):
+        return None
+
+
+def _parse_search_cursor(cursor):
+    after = decode_cursor(cursor)
+    if not isinstance(after, dict) or not isinstance(after.get("offset"), int):
+        return None
+    values = after.get("values")
+    if values is not None and not (isinstance(values, list) and len(values) == 2):
+        return None
+    return after
+
+
 """ Product List Resource """
 
 
 @products_ns.route("")
 class ProductList(Resource):
     @classmethod
+    @versions.conditional(*PRODUCT_TABLES)
+    @response_cache.cached("products")
     @products_ns.doc("list_products")
     @products_ns.expect(_products_parser)
-    @products_ns.marshal_list_with(ProductSchema, envelope="product_list")
+    @products_ns.response(400, INVALID_CURSOR)
+    @products_ns.marshal_with(ProductPageSchema)
     def get(cls):
         data = _products_parser.parse_args()
         page = data.get("page")
-        per_page = data.get("per_page")
+        limit = data.get("per_page")
         tags = data.get("tags")
+        in_stock = data.get("in_stock")
+        cursor = data.get("cursor")
+        sort = data.get("sort")
 
-        products_query = ProductModel.query
+        after = None
+        if cursor and not page:
+            parsed = _parse_cursor(cursor)
+            if not parsed:
+                return api.abort(400, INVALID_CURSOR)
+            sort, value, last_id = parsed
+            after = (value, last_id)
 
-        if tags and len(tags) > 0:
-            products_query = (
-                products_query.join(ProductTagAssoc)
-                .join(TagModel)
-                .filter(TagModel.slug.in_(tags))
+        products_query = _document_query(
+            ProductModel.query.filter_by(active=True)
+        ).order_by(*_order_by(sort))
+
+        # Tag and stock filters are resolved against the in-memory bitmaps,
+        # which also give the page; the database only hydrates its ids.
+        matched = tag_index.match(
+            tags, match_all=data.get("tag_mode") == "all", in_stock=in_stock
+        )
+        if tags:
+            response_cache.tag(*(f"tag-slug:{tag}" for tag in tags))
+        if tags or in_stock is not None:
+            page_ids = tag_index.page(
+                matched,
+                sort,
+                limit + 1,
+                offset=(page - 1) * limit if page else 0,
+                after=after,
             )
+            products = products_query.filter(ProductModel.id.in_(page_ids)).all()
+        elif page:
+            products = products_query.offset((page - 1) * limit).limit(limit + 1).all()
+        else:
+            if after:
+                products_query = products_query.filter(_after_cursor(sort, *after))
+            products = products_query.limit(limit + 1).all()
+
+        next_cursor = None
+        if len(products) > limit:
+            products = products[:limit]
+            if not page:
+                next_cursor = _cursor_for(sort, products[-1])
+
+        for product in products:
+            response_cache.tag(*product_tags(product))
+        return (
+            {
+                "product_list": load_product_documents(products),
+                "next_cursor": next_cursor,
+                "tag_facets": tag_index.facets(matched),
+            },
+            200,
+        )
 
+
+""" Product Search Resource """
+
+
+@products_ns.route("/search")
+class ProductSearch(Resource):
+    @classmethod
+    @products_ns.doc("search_products")
+    @products_ns.expect(_search_parser)
+    @products_ns.response(400, INVALID_CURSOR)
+    @products_ns.marshal_with(ProductSearchSchema)
+    def get(cls):
+        data = _search_parser.parse_args()
+        page = data.get("page")
+        cursor = data.get("cursor")
+        options = dict(
+            fields=ProductModel.__search_fields__,
+            facets=ProductModel.__search_facets__,
+            filters={
+                "brand": data.get("brand"),
+                "tags": data.get("tag"),
+                "price": (data.get("price_min"), data.get("price_max")),
+            },
+        )
+
+        next_cursor = None
         if page:
-            products = (
-                products_query.filter_by(active=True)
-                .paginate(page, per_page, False)
-                .items
+            ids, total, facets = es.query_index(
+                ProductModel.__tablename__,
+                data.get("q"),
+                max(page, 1),
+                data.get("per_page"),
+                **options,
             )
         else:
-            products = products_query.filter_by(active=True).all()
+            # Cursor mode: search_after pages, facets come with the first.
+            after = None
+            if cursor:
+                after = _parse_search_cursor(cursor)
+                if not after:
+                    return api.abort(400, INVALID_CURSOR)
+            ids, total, facets, after = es.query_index_after(
+                ProductModel.__tablename__,
+                data.get("q"),
+                data.get("per_page"),
+                after,
+                **options,
+            )
+            next_cursor = encode_cursor(after) if after else None
+        if not ids:
+            return (
+                {
+                    "product_list": [],
+                    "total": total,
+                    "next_cursor": next_cursor,
+                    "facets": facets,
+                },
+                200,
+            )
+
+        # One IN query, then back into relevance order.
+        rows = _document_query(
+            ProductModel.query.filter_by(active=True).filter(ProductModel.id.in_(ids))
+        ).all()
+        rank = {product_id: index for index, product_id in enumerate(ids)}
+        rows.sort(key=lambda row: rank[row.id])
+        return (
+            {
+                "product_list": load_product_documents(rows),
+                "total": total,
+                "next_cursor": next_cursor,
+                "facets": facets,
+            },
+            200,
+        )
+
 
-        return products, 200
+""" Product Suggest Resource """
+
+
+@products_ns.route("/suggest")
+class ProductSuggest(Resource):
+    @classmethod
+    @products_ns.doc("suggest_products")
+    @products_ns.expect(_suggest_parser)
+    @products_ns.marshal_list_with(SuggestionSchema, envelope="suggestions")
+    def get(cls):
+        data = _suggest_parser.parse_args()
+        try:
+            return suggest_index.suggest(data.get("q"), data.get("limit")), 200
+        except Exception as ex:
+            # The in-process index could not be built, ask Elasticsearch.
+            print(ex)
+        suggestions = es.suggest(
+            ProductModel.__tablename__, data.get("q"), data.get("limit")
+        )
+        return [dict(suggestion, kind="product") for suggestion in suggestions], 200
 
 
 """ Product Resource """
@@ -119,11 +433,14 @@ class ProductList(Resource):
 @product_ns.route("/<string:slug>", doc={"params": {"slug": "slug name"}})
 class Product(Resource):
     @classmethod
+    @versions.conditional(*PRODUCT_TABLES)
+    @response_cache.cached()
     @product_ns.doc("get_product")
     @product_ns.response(404, NOT_FOUND_ERROR.format(RESOURCE_NAME))
     @product_ns.marshal_with(ProductSchema, envelope="product_item")
     def get(cls, slug):
-        product = ProductModel.query.filter_by(slug=slug).first()
+        product = _document_query(ProductModel.query.filter_by(slug=slug)).first()
         if not product:
             return api.abort(404, NOT_FOUND_ERROR.format(RESOURCE_NAME))
-        return product, 200
+        response_cache.tag(*product_tags(product))
+        return load_product_documents([product])[0], 200
@@ -1,6 +1,11 @@
 from flask_restplus import Resource, fields
-from app import api
-from app.models import ProductTag as TagModel
+from sqlalchemy import and_, distinct, func, true
+from app import api, db, response_cache, versions
+from app.models import (
+    ProductTag as TagModel,
+    Product as ProductModel,
+    product_and_tag_assoc as ProductTagAssoc,
+)
 from . import INTERNAL_ERROR
 
 """ Tag Response Schema """
@@ -18,11 +23,34 @@ tags_ns = api.namespace("tags", description="Tag API")
 @tags_ns.route("")
 class Tags(Resource):
     @classmethod
+    @versions.conditional(TagModel.__tablename__, ProductModel.__tablename__)
+    @response_cache.cached("tags")
     @tags_ns.doc("list_tags")
     @tags_ns.marshal_with(TagSchema, envelope="tag_list")
     def get(cls):
         try:
-            tags = TagModel.query.filter_by(active=True).all()
+            # Active product counts come from the same grouped query.
+            rows = (
+                db.session.query(TagModel, func.count(distinct(ProductModel.id)))
+                .outerjoin(
+                    ProductTagAssoc, ProductTagAssoc.c.product_tag_id == TagModel.id
+                )
+                .outerjoin(
+                    ProductModel,
+                    and_(
+                        ProductModel.id == ProductTagAssoc.c.product_id,
+                        ProductModel.active == true(),
+                    ),
+                )
+                .filter(TagModel.active == true())
+                .group_by(TagModel.id)
+                .all()
+            )
         except Exception as ex:
             return {"message": INTERNAL_ERROR}, 500
+        response_cache.tag(*(f"tag:{tag.id}" for tag, _ in rows))
+        tags = [
+            {"name": tag.name, "slug": tag.slug, "total_products": total}
+            for tag, total in rows
+        ]
         return tags
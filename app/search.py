@@ -1,5 +1,111 @@
-from elasticsearch import Elasticsearch
-from elasticsearch.helpers import bulk
+from elasticsearch import Elasticsearch, ElasticsearchException, NotFoundError
+from elasticsearch.helpers import bulk, streaming_bulk, parallel_bulk
+from collections import Counter, defaultdict
+from decimal import Decimal
+from itertools import chain, islice
+from operator import attrgetter
+from sqlalchemy import inspect, and_, or_, text
+from redis import RedisError
+import hashlib
+import json
+import math
+import time
+
+
+def _windows(iterable, size):
+    iterator = iter(iterable)
+    window = list(islice(iterator, size))
+    while window:
+        yield window
+        window = list(islice(iterator, size))
+
+
+def _related_value(relation, subfields):
+    related = attrgetter(relation)
+    if len(subfields) == 1:
+        subfield = attrgetter(subfields[0])
+
+        def extract(obj):
+            value = related(obj)
+            return None if value is None else subfield(value)
+
+    else:
+        values = attrgetter(*subfields)
+
+        def extract(obj):
+            value = related(obj)
+            return None if value is None else dict(zip(subfields, values(value)))
+
+    return extract
+
+
+def _related_list(relation, subfields):
+    related = attrgetter(relation)
+    if len(subfields) == 1:
+        name, subfield = subfields[0], attrgetter(subfields[0])
+        return lambda obj: [{name: subfield(item)} for item in related(obj)]
+    values = attrgetter(*subfields)
+    return lambda obj: [dict(zip(subfields, values(item))) for item in related(obj)]
+
+
+def compile_searchable(model):
+    """Turn ``model.__searchable__`` into a payload function.
+
+    The spec is read once: whether a relationship is a collection comes from
+    the mapper, and every field becomes a chain of attrgetters. A missing
+    many-to-one (e.g. no brand) yields None.
+    """
+    relationships = inspect(model).relationships
+    extractors = list()
+    for field in model.__searchable__:
+        if isinstance(field, str):
+            extractors.append((field, attrgetter(field)))
+            continue
+        relation, subfields = field
+        if relationships[relation].uselist:
+            extractors.append((relation, _related_list(relation, subfields)))
+        else:
+            extractors.append((relation, _related_value(relation, subfields)))
+
+    def extract(obj):
+        return {name: extractor(obj) for name, extractor in extractors}
+
+    return extract
+
+
+def _flatten(values):
+    for value in values:
+        if isinstance(value, list):
+            yield from value
+        else:
+            yield value
+
+
+def _payload_values(payload, path):
+    """Leaf values of ``payload`` at a dotted mapping ``path``.
+
+    Trailing names that are not in the payload (multi-fields such as
+    ``brand.text``) are ignored.
+    """
+    values = [payload]
+    for name in path.split("."):
+        nested = [
+            value[name]
+            for value in _flatten(values)
+            if isinstance(value, dict) and name in value
+        ]
+        if not nested:
+            break
+        values = nested
+    return [
+        value
+        for value in _flatten(values)
+        if value is not None and not isinstance(value, dict)
+    ]
+
+
+def _json_default(value):
+    return float(value) if isinstance(value, Decimal) else str(value)
 
 
 class Elastic(object):
@@ -12,9 +118,12 @@ class Elastic(object):
             )
 
         self.object = None
+        self.local = None
+        self.cache = None
+        self.rebuilds = None
         self.db = db
 
-    def init_app(self, app, db):
+    def init_app(self, app, db, redis_store=None):
         self.object = (
             Elasticsearch([app.config["ELASTICSEARCH_URL"]])
             if app.config["ELASTICSEARCH_URL"]
@@ -22,66 +131,171 @@ class Elastic(object):
         )
         self.db = db
         self.bulk_queue = []
+        self.payload_extractors = dict()
+        self.replicas = app.config["ELASTICSEARCH_REPLICAS"]
+        self.refresh_interval = app.config["ELASTICSEARCH_REFRESH_INTERVAL"]
+        self.versions_kept = app.config["ELASTICSEARCH_INDEX_VERSIONS_KEPT"]
+        self.chunk_size = app.config["ELASTICSEARCH_BULK_CHUNK_SIZE"]
+        self.max_chunk_bytes = app.config["ELASTICSEARCH_BULK_MAX_BYTES"]
+        self.thread_count = app.config["ELASTICSEARCH_BULK_THREADS"]
+        self.suggest_field = app.config["ELASTICSEARCH_SUGGEST_FIELD"]
+        self.pit_keep_alive = app.config["ELASTICSEARCH_PIT_KEEP_ALIVE"]
+        self.local = DatabaseSearch(db) if app.config["SEARCH_LOCAL_BACKEND"] else None
+        self.cache = SearchCache(app, redis_store) if redis_store else None
+        self.rebuilds = RebuildLog(redis_store) if redis_store else None
 
-    def add_to_bulk_queue(self, index, model_object, operation):
-        if operation == 'delete':
-            entry = {
-                "_op_type": operation,
-                "_index": index,
-                "_type": index,
-                "_id": model_object.id
-            }
-        elif operation == 'index':
-            entry = {
+    @property
+    def enabled(self):
+        return self.object is not None or self.local is not None
+
+    def create_index_version(self, alias, body=None):
+        """Create ``<alias>_v<timestamp>`` set up for bulk loading.
+
+        ``body`` carries the explicit settings and mappings of the index.
+        """
+        index = f"{alias}_v{time.strftime('%Y%m%d%H%M%S', time.gmtime())}"
+        body = dict(body or {})
+        body["settings"] = dict(
+            body.get("settings", {}), refresh_interval="-1", number_of_replicas=0
+        )
+        self.object.indices.create(index=index, body=body)
+        return index
+
+    def publish_index_version(self, alias, index):
+        """Restore serving settings and atomically point ``alias`` at ``index``."""
+        self.object.indices.put_settings(
+            index=index,
+            body={
+                "refresh_interval": self.refresh_interval,
+                "number_of_replicas": self.replicas,
+            },
+        )
+        self.object.indices.refresh(index=index)
+
+        actions = [{"add": {"index": index, "alias": alias}}]
+        if self.object.indices.exists_alias(name=alias):
+            for current in self.object.indices.get_alias(name=alias):
+                actions.insert(0, {"remove": {"index": current, "alias": alias}})
+        elif self.object.indices.exists(index=alias):
+            # An index created before aliases were used holds the name.
+            actions.insert(0, {"remove_index": {"index": alias}})
+        self.object.indices.update_aliases(body={"actions": actions})
+        self.changed()
+        self.drop_index_versions(alias)
+
+    def drop_index_versions(self, alias):
+        """Delete all but the newest ``versions_kept`` versions of ``alias``."""
+        current = set(self.object.indices.get_alias(name=alias))
+        versions = sorted(self.object.indices.get(index=f"{alias}_v*"), reverse=True)
+        for index in versions[self.versions_kept :]:
+            if index not in current:
+                self.object.indices.delete(index=index)
+
+    def make_delete_entry(self, index, object_id):
+        return {"_op_type": "delete", "_index": index, "_id": object_id}
+
+    def make_bulk_entry(self, index, model_object, operation):
+        if operation == "delete":
+            return self.make_delete_entry(index, model_object.id)
+        elif operation == "index":
+            return {
                 "_op_type": operation,
                 "_index": index,
-                "_type": index,
                 "_id": model_object.id,
-                "_source": self._create_payload(model_object)
+                "_source": self._create_payload(model_object),
             }
-        else:
-            return
-        
-        self.bulk_queue.append(entry)
+
+    def add_to_bulk_queue(self, index, model_object, operation):
+        entry = self.make_bulk_entry(index, model_object, operation)
+        if entry:
+            self.bulk_queue.append(entry)
 
     def clear_bulk_queue(self):
         self.bulk_queue = []
-        
+
     def perform_bulk(self):
-        bulk(self.object, self.bulk_queue)
+        # Transport errors raise, per item failures are returned. Writes
+        # must be searchable before cached results are dropped, otherwise
+        # stale hits get cached under the new version.
+        self.record_writes(self.bulk_queue)
+        _, errors = bulk(
+            self.object, self.bulk_queue, raise_on_error=False, refresh="wait_for"
+        )
         self.clear_bulk_queue()
+        self.changed()
+        return errors
+
+    def stream_bulk(self, entries, chunk_size=None, thread_count=None):
+        """Send an iterable of bulk entries in bounded chunks.
+
+        Returns the number of indexed documents and the failed items.
+        """
+        chunk_size = chunk_size or self.chunk_size
+        thread_count = thread_count or self.thread_count
+        options = dict(
+            chunk_size=chunk_size,
+            max_chunk_bytes=self.max_chunk_bytes,
+            raise_on_error=False,
+        )
+        if thread_count > 1:
+            # Entries are pulled on this thread, which owns the app context
+            # and the database session; only the requests run in the pool.
+            results = chain.from_iterable(
+                parallel_bulk(self.object, window, thread_count=thread_count, **options)
+                for window in _windows(entries, chunk_size * thread_count)
+            )
+        else:
+            results = streaming_bulk(self.object, entries, **options)
+
+        indexed, failed = 0, list()
+        for ok, item in results:
+            if ok:
+                indexed += 1
+            else:
+                failed.append(item)
+        return indexed, failed
+
+    def bulk_apply(self, entries):
+        if not self.object:
+            return
+        entries = [entry for entry in entries if entry]
+        self.record_writes(entries)
+        try:
+            _, errors = bulk(
+                self.object, entries, raise_on_error=False, refresh="wait_for"
+            )
+        except Exception as ex:
+            print(ex)
+        else:
+            # Inactive objects are deleted whether or not they were indexed.
+            for error in errors:
+                if error.get("delete", {}).get("status") != 404:
+                    print(error)
+        self.changed()
+
+    def record_writes(self, entries):
+        """Note writes to an index that is being rebuilt, see RebuildLog."""
+        if self.rebuilds:
+            self.rebuilds.record(entries)
+
+    def changed(self):
+        """Documents were written, cached search results are out of date."""
+        if self.cache:
+            self.cache.bump()
 
     def _create_payload(self, model_object):
-        payload = dict()
-        for field in model_object.__searchable__:
-            if isinstance(field, str):
-                payload[field] = getattr(model_object, field)
-            if isinstance(field, tuple):
-                subfields = field[1]
-                field = field[0]
-                if not isinstance(getattr(model_object, field), list):
-                    if len(subfields) == 1:
-                        payload[field] = getattr(
-                            getattr(model_object, field), subfields[0]
-                        )
-                    else:
-                        payload[field] = dict()
-                        for subfield in subfields:
-                            payload[field][subfield] = getattr(
-                                getattr(model_object, field), subfield
-                            )
-                else:
-                    payload[field] = list()
-                    for sub_model_object in getattr(model_object, field):
-                        subfield_group = dict()
-                        for subfield in subfields:
-                            subfield_group[subfield] = getattr(
-                                sub_model_object, subfield
-                            )
-                        payload[field].append(subfield_group)
-        return payload
+        model = type(model_object)
+        extractor = self.payload_extractors.get(model)
+        if extractor is None:
+            extractor = self.payload_extractors[model] = compile_searchable(model)
+        return extractor(model_object)
 
     def add_to_index(self, index, model_object):
+        if self.local:
+            self.local.apply(
+                self.db.session.connection(),
+                [self.make_bulk_entry(index, model_object, "index")],
+            )
         if not self.object:
             return
         # payload = dict()
@@ -101,23 +315,760 @@ class Elastic(object):
         #     else:
         #         payload[field] = getattr(model, field)
         payload = self._create_payload(model_object)
-        self.object.index(index=index, doc_type=index, id=model_object.id, body=payload)
+        self.record_writes([{"_index": index, "_id": model_object.id}])
+        self.object.index(index=index, id=model_object.id, body=payload)
 
     def remove_from_index(self, index, model_object):
+        if self.local:
+            self.local.apply(
+                self.db.session.connection(),
+                [self.make_delete_entry(index, model_object.id)],
+            )
         if not self.object:
             return
-        self.object.delete(index=index, doc_type=index, id=model_object.id)
+        self.record_writes([{"_index": index, "_id": model_object.id}])
+        self.object.delete(index=index, id=model_object.id)
 
-    def query_index(self, index, query, page, per_page):
-        if not self.object:
-            return [], 0
+    def query_index(
+        self, index, query, page, per_page, fields=("*",), facets=None, filters=None
+    ):
+        """Search ``index`` and return hit ids, total hits and facet buckets.
+
+        ``facets`` maps facet names to terms/histogram aggregations, counted
+        over the whole query. ``filters`` holds the selected values per facet
+        (a ``(min, max)`` pair for histograms) and only narrows the hits.
+
+        Without Elasticsearch, or when it fails, the database copy answers.
+        Results are cached in Redis until the next index write.
+        """
+        facets = facets or dict()
+        filters = filters or dict()
+        if not self.cache:
+            return self._query(index, query, page, per_page, fields, facets, filters)
+        key = self.cache.make_key(index, query, page, per_page, fields, facets, filters)
+        return self.cache.fetch(
+            key,
+            lambda: self._query(index, query, page, per_page, fields, facets, filters),
+        )
+
+    def _query(self, index, query, page, per_page, fields, facets, filters):
+        if self.object:
+            try:
+                return self._search(
+                    index, query, page, per_page, fields, facets, filters
+                )
+            except ElasticsearchException as ex:
+                if not self.local:
+                    raise
+                print(ex)
+        if self.local:
+            return self.local.query(index, query, page, per_page, facets, filters)
+        return [], 0, {name: [] for name in facets}
+
+    def _search(self, index, query, page, per_page, fields, facets, filters):
+        body = {
+            "query": {"multi_match": {"query": query, "fields": list(fields)}},
+            "_source": False,
+            "from": (page - 1) * per_page,
+            "size": per_page,
+        }
+        if facets:
+            body["aggs"] = facets
+        post_filter = self._facet_filter(facets, filters)
+        if post_filter:
+            body["post_filter"] = post_filter
+        search = self.object.search(index=index, body=body)
+        ids = [int(hit["_id"]) for hit in search["hits"]["hits"]]
+        total = search["hits"]["total"]
+        return (
+            ids,
+            total["value"] if isinstance(total, dict) else total,
+            self._facet_buckets(facets, search.get("aggregations", {})),
+        )
+
+    def query_index_after(
+        self,
+        index,
+        query,
+        per_page,
+        after=None,
+        fields=("*",),
+        facets=None,
+        filters=None,
+    ):
+        """Cursor paging with ``search_after`` on (score, id).
+
+        ``after`` is the state returned with the previous page, None for the
+        first one. Returns hit ids, total hits, facet buckets (filled on the
+        first page only) and the state of the next page, None after the
+        last. With ``pit_keep_alive`` set, every page of a walk is read from
+        the same point in time.
+        """
+        facets = facets or dict()
+        filters = filters or dict()
+        args = (index, query, per_page, after or dict(), fields, facets, filters)
+        if not self.cache or self.pit_keep_alive:
+            # Point in time pages belong to a single reader.
+            return self._query_after(*args)
+        key = self.cache.make_key(
+            index, query, ["after", after], per_page, fields, facets, filters
+        )
+        return self.cache.fetch(key, lambda: self._query_after(*args))
+
+    def _query_after(self, index, query, per_page, after, fields, facets, filters):
+        if self.object:
+            try:
+                return self._search_after(
+                    index, query, per_page, after, fields, facets, filters
+                )
+            except ElasticsearchException as ex:
+                if not self.local:
+                    raise
+                print(ex)
+        if self.local:
+            return self.local.query_after(
+                index, query, per_page, after, facets, filters
+            )
+        return [], 0, {name: [] for name in facets}, None
+
+    def _search_after(self, index, query, per_page, after, fields, facets, filters):
+        body = {
+            "query": {"multi_match": {"query": query, "fields": list(fields)}},
+            "_source": False,
+            "size": per_page + 1,
+            "sort": [{"_score": "desc"}, {"id": "asc"}],
+        }
+        offset = after.get("offset", 0)
+        if after.get("values"):
+            body["search_after"] = after["values"]
+        elif offset:
+            # A cursor handed out by the database backend.
+            body["from"] = offset
+        if facets and not after:
+            body["aggs"] = facets
+        post_filter = self._facet_filter(facets, filters)
+        if post_filter:
+            body["post_filter"] = post_filter
+
+        pit = None
+        if self.pit_keep_alive:
+            search, pit = self._search_point_in_time(index, body, after.get("pit"))
+        else:
+            search = self.object.search(index=index, body=body)
+        hits = search["hits"]["hits"]
+        total = search["hits"]["total"]
+        next_after = None
+        if len(hits) > per_page:
+            hits = hits[:per_page]
+            next_after = {"values": hits[-1]["sort"], "offset": offset + per_page}
+            if pit:
+                next_after["pit"] = pit
+        elif pit:
+            self.close_point_in_time(pit)
+        return (
+            [int(hit["_id"]) for hit in hits],
+            total["value"] if isinstance(total, dict) else total,
+            self._facet_buckets(facets, search.get("aggregations", {})),
+            next_after,
+        )
+
+    def _search_point_in_time(self, index, body, pit):
+        # The client predates the point in time API, so it is called
+        # through the transport. Searches on a PIT name no index.
+        if pit:
+            body["pit"] = {"id": pit, "keep_alive": self.pit_keep_alive}
+            try:
+                search = self.object.search(body=body)
+                return search, search.get("pit_id", pit)
+            except NotFoundError as ex:
+                # Expired, carry on from a fresh one.
+                print(ex)
+        pit = self.object.transport.perform_request(
+            "POST", f"/{index}/_pit", params={"keep_alive": self.pit_keep_alive}
+        )["id"]
+        body["pit"] = {"id": pit, "keep_alive": self.pit_keep_alive}
+        search = self.object.search(body=body)
+        return search, search.get("pit_id", pit)
+
+    def close_point_in_time(self, pit):
+        try:
+            self.object.transport.perform_request("DELETE", "/_pit", body={"id": pit})
+        except ElasticsearchException as ex:
+            print(ex)
+
+    def suggest(self, index, prefix, size=10):
+        """Completion suggestions for ``prefix`` from ``suggest_field``."""
+        if not self.object or not self.suggest_field:
+            return []
         search = self.object.search(
             index=index,
             body={
-                "query": {"multi_match": {"query": query, "fields": ["*"]}},
-                "from": (page - 1) * per_page,
-                "size": per_page,
+                "_source": ["name", "slug"],
+                "suggest": {
+                    "names": {
+                        "prefix": prefix,
+                        "completion": {
+                            "field": self.suggest_field,
+                            "size": size,
+                            "skip_duplicates": True,
+                        },
+                    }
+                },
             },
         )
-        # ids = [int(hit['_id']) for hit in search['hits']['hits']]
-        return search
+        return [
+            option["_source"]
+            for suggestion in search["suggest"]["names"]
+            for option in suggestion["options"]
+        ]
+
+    def _facet_filter(self, facets, filters):
+        clauses = list()
+        for name, selected in filters.items():
+            if not selected or name not in facets:
+                continue
+            [(kind, spec)] = facets[name].items()
+            if kind == "terms":
+                clauses.append({"terms": {spec["field"]: list(selected)}})
+            else:
+                low, high = selected
+                bounds = dict()
+                if low is not None:
+                    bounds["gte"] = low
+                if high is not None:
+                    bounds["lte"] = high
+                if bounds:
+                    clauses.append({"range": {spec["field"]: bounds}})
+        return {"bool": {"filter": clauses}} if clauses else None
+
+    def _facet_buckets(self, facets, aggregations):
+        return {
+            name: [
+                {"key": bucket["key"], "count": bucket["doc_count"]}
+                for bucket in aggregations.get(name, {}).get("buckets", [])
+            ]
+            for name in facets
+        }
+
+
+class RebuildLog(object):
+    """Ids written to an index alias while a new version is being built.
+
+    Those writes go to the old version through the alias, and the bulk
+    load may have read the rows before they changed. The ids are replayed
+    into the alias once it points at the new version. A rebuild marker
+    expires on its own if the rebuilding process dies.
+    """
+
+    ACTIVE_KEY = "search-rebuild:{}"
+    WRITES_KEY = "search-rebuild:{}:writes"
+    MARKER_TTL = 24 * 60 * 60
+
+    RECORD_SCRIPT = """
+        if redis.call('EXISTS', KEYS[1]) == 1 then
+            redis.call('SADD', KEYS[2], unpack(ARGV))
+        end
+        return 1
+    """
+
+    def __init__(self, redis_store):
+        self.redis_store = redis_store
+        self._record = redis_store.object.register_script(self.RECORD_SCRIPT)
+
+    def start(self, alias):
+        pipe = self.redis_store.object.pipeline()
+        pipe.delete(self.WRITES_KEY.format(alias))
+        pipe.set(self.ACTIVE_KEY.format(alias), 1, ex=self.MARKER_TTL)
+        pipe.execute()
+
+    def record(self, entries):
+        object_ids = defaultdict(set)
+        for entry in entries:
+            object_ids[entry["_index"]].add(entry["_id"])
+        try:
+            pipe = self.redis_store.object.pipeline(transaction=False)
+            for index, ids in object_ids.items():
+                self._record(
+                    keys=[self.ACTIVE_KEY.format(index), self.WRITES_KEY.format(index)],
+                    args=list(ids),
+                    client=pipe,
+                )
+            pipe.execute()
+        except RedisError as ex:
+            print(ex)
+
+    def finish(self, alias):
+        """End the rebuild of ``alias`` and return the ids written meanwhile."""
+        pipe = self.redis_store.object.pipeline()
+        pipe.delete(self.ACTIVE_KEY.format(alias))
+        pipe.smembers(self.WRITES_KEY.format(alias))
+        pipe.delete(self.WRITES_KEY.format(alias))
+        _, object_ids, _ = pipe.execute()
+        return sorted(int(object_id) for object_id in object_ids)
+
+
+class SearchCache(object):
+    """``query_index`` results cached in Redis.
+
+    Only ids, totals and facets are stored. Keys carry a global search
+    version that every index write increments, so entries from before the
+    write are never read again and expire with their TTL. Hits and misses
+    are counted to help size that TTL.
+    """
+
+    KEY_PREFIX = "search-cache:"
+    VERSION_KEY = "search-cache:version"
+    STATS_KEY = "search-cache:stats"
+
+    def __init__(self, app=None, redis_store=None):
+        self.redis_store = redis_store
+        self.ttl = None
+        if app:
+            self.init_app(app, redis_store)
+
+    def init_app(self, app, redis_store):
+        self.redis_store = redis_store
+        self.ttl = app.config["SEARCH_CACHE_TTL"]
+
+    def make_key(self, index, query, page, per_page, fields, facets, filters):
+        selected = sorted(
+            (name, sorted(values) if isinstance(values, list) else values)
+            for name, values in filters.items()
+            if values and any(value is not None for value in values)
+        )
+        digest = hashlib.sha1(
+            json.dumps(
+                [
+                    " ".join(query.lower().split()),
+                    page,
+                    per_page,
+                    list(fields),
+                    facets,
+                    selected,
+                ],
+                sort_keys=True,
+                default=str,
+            ).encode()
+        ).hexdigest()
+        return f"{index}:{digest}"
+
+    def fetch(self, key, search):
+        """Cached result for ``key``, running ``search`` on a miss."""
+        if not self.ttl:
+            return search()
+        try:
+            version = self.redis_store.object.get(self.VERSION_KEY) or "0"
+            key = f"{self.KEY_PREFIX}{version}:{key}"
+            entry = self.redis_store.object.get(key)
+            self.redis_store.object.hincrby(
+                self.STATS_KEY, "misses" if entry is None else "hits"
+            )
+        except RedisError as ex:
+            print(ex)
+            return search()
+        if entry is not None:
+            return tuple(json.loads(entry))
+
+        result = search()
+        try:
+            self.redis_store.object.set(
+                key, json.dumps(result, default=_json_default), ex=self.ttl
+            )
+        except RedisError as ex:
+            print(ex)
+        return result
+
+    def bump(self):
+        try:
+            self.redis_store.object.incr(self.VERSION_KEY)
+        except RedisError as ex:
+            print(ex)
+
+    def stats(self):
+        stats = self.redis_store.object.hgetall(self.STATS_KEY)
+        return {name: int(stats.get(name, 0)) for name in ("hits", "misses")}
+
+
+class DatabaseSearch(object):
+    """Full-text search over the ``search_documents`` table.
+
+    The table holds the same documents as Elasticsearch, written from the
+    same bulk entries. Matching uses the database's own full-text support:
+    the FULLTEXT index on MySQL and the FTS5 table kept up by triggers on
+    SQLite, with LIKE elsewhere. Filters and facets are worked out from the
+    stored payloads of the matching documents. Field boosts are not
+    supported, the ``__search_fields__`` of a model only choose the text
+    that is matched.
+    """
+
+    SQLITE_SCHEMA = (
+        """CREATE VIRTUAL TABLE IF NOT EXISTS search_documents_fts
+        USING fts5(content, content='search_documents', content_rowid='id')""",
+        """CREATE TRIGGER IF NOT EXISTS search_documents_ai
+        AFTER INSERT ON search_documents BEGIN
+            INSERT INTO search_documents_fts(rowid, content)
+            VALUES (new.id, new.content);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS search_documents_ad
+        AFTER DELETE ON search_documents BEGIN
+            INSERT INTO search_documents_fts(search_documents_fts, rowid, content)
+            VALUES ('delete', old.id, old.content);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS search_documents_au
+        AFTER UPDATE ON search_documents BEGIN
+            INSERT INTO search_documents_fts(search_documents_fts, rowid, content)
+            VALUES ('delete', old.id, old.content);
+            INSERT INTO search_documents_fts(rowid, content)
+            VALUES (new.id, new.content);
+        END""",
+    )
+
+    SQLITE_FTS_REBUILD = (
+        "INSERT INTO search_documents_fts(search_documents_fts) VALUES ('rebuild')"
+    )
+
+    def __init__(self, db):
+        self.db = db
+        self.content_fields = dict()
+        self.fts_ready = False
+
+    @property
+    def table(self):
+        from app.models import SearchDocument
+
+        return SearchDocument.__table__
+
+    def setup(self, connection):
+        """Create the SQLite full-text table if the schema came from create_all.
+
+        The table is filled from the rows already there before the triggers
+        exist, so they never delete entries it does not hold.
+        """
+        if connection.dialect.name != "sqlite":
+            return
+        create_table, *triggers = self.SQLITE_SCHEMA
+        if not self._has_fts(connection):
+            connection.execute(text(create_table))
+            connection.execute(text(self.SQLITE_FTS_REBUILD))
+        for statement in triggers:
+            connection.execute(text(statement))
+
+    def _has_fts(self, connection):
+        if not self.fts_ready:
+            self.fts_ready = (
+                connection.execute(
+                    text(
+                        "SELECT 1 FROM sqlite_master "
+                        "WHERE type = 'table' AND name = 'search_documents_fts'"
+                    )
+                ).first()
+                is not None
+            )
+        return self.fts_ready
+
+    def apply(self, connection, entries):
+        """Write bulk entries (as made by ``Elastic.make_bulk_entry``)."""
+        table = self.table
+        object_ids = defaultdict(set)
+        rows = list()
+        for entry in entries:
+            if not entry:
+                continue
+            object_ids[entry["_index"]].add(entry["_id"])
+            if entry["_op_type"] == "index":
+                rows.append(self._row(entry))
+        for index, ids in object_ids.items():
+            connection.execute(
+                table.delete().where(
+                    and_(table.c.index_name == index, table.c.object_id.in_(ids))
+                )
+            )
+        if rows:
+            connection.execute(table.insert(), rows)
+        return len(rows)
+
+    def rebuild(self, connection, index, entries, chunk_size):
+        """Replace every document of ``index`` with ``entries``."""
+        self.setup(connection)
+        table = self.table
+        connection.execute(table.delete().where(table.c.index_name == index))
+        indexed = 0
+        for window in _windows(entries, chunk_size):
+            indexed += self.apply(connection, window)
+        if connection.dialect.name == "sqlite":
+            connection.execute(text(self.SQLITE_FTS_REBUILD))
+        return indexed
+
+    def query(self, index, query, page, per_page, facets, filters):
+        hits, buckets = self._results(index, query, facets, filters)
+        start = (page - 1) * per_page
+        return hits[start : start + per_page], len(hits), buckets
+
+    def query_after(self, index, query, per_page, after, facets, filters):
+        """Cursor paging by offset, see ``Elastic.query_index_after``."""
+        hits, buckets = self._results(index, query, facets, filters)
+        if after:
+            buckets = {name: [] for name in facets}
+        offset = after.get("offset", 0)
+        next_after = None
+        if len(hits) > offset + per_page:
+            next_after = {"offset": offset + per_page}
+        return hits[offset : offset + per_page], len(hits), buckets, next_after
+
+    def _results(self, index, query, facets, filters):
+        matches = [
+            (object_id, json.loads(payload))
+            for object_id, payload in self._match(index, query)
+        ]
+        buckets = self._facet_buckets(facets, [payload for _, payload in matches])
+        hits = [
+            object_id
+            for object_id, payload in matches
+            if self._matches_filters(facets, filters, payload)
+        ]
+        return hits, buckets
+
+    def _row(self, entry):
+        payload = entry["_source"]
+        fields = self._content_fields(entry["_index"])
+        if fields:
+            words = [
+                str(value)
+                for field in fields
+                for value in _payload_values(payload, field.split("^")[0])
+            ]
+        else:
+            words = [
+                value
+                for field in payload
+                for value in _payload_values(payload, field)
+                if isinstance(value, str)
+            ]
+        return {
+            "index_name": entry["_index"],
+            "object_id": entry["_id"],
+            "content": " ".join(words),
+            "payload": json.dumps(payload, default=_json_default),
+        }
+
+    def _content_fields(self, index):
+        if index not in self.content_fields:
+            from app.models import SearchableMixin
+
+            model = SearchableMixin.searchable_models().get(index)
+            self.content_fields[index] = getattr(model, "__search_fields__", None)
+        return self.content_fields[index]
+
+    def _match(self, index, query):
+        """``(object_id, payload)`` rows matching ``query``, best first."""
+        terms = query.split()
+        if not terms:
+            return []
+        session = self.db.session
+        dialect = session.get_bind().dialect.name
+        if dialect == "mysql":
+            return session.execute(
+                text(
+                    "SELECT object_id, payload FROM search_documents "
+                    "WHERE index_name = :index "
+                    "AND MATCH (content) AGAINST (:query) "
+                    "ORDER BY MATCH (content) AGAINST (:query) DESC, object_id"
+                ),
+                {"index": index, "query": query},
+            ).fetchall()
+        if dialect == "sqlite" and self._has_fts(session):
+            # Quoted terms, any of which may match, like a multi_match.
+            expression = " OR ".join(
+                '"{}"'.format(term.replace('"', '""')) for term in terms
+            )
+            return session.execute(
+                text(
+                    "SELECT d.object_id, d.payload FROM search_documents_fts "
+                    "JOIN search_documents d ON d.id = search_documents_fts.rowid "
+                    "WHERE search_documents_fts MATCH :query "
+                    "AND d.index_name = :index "
+                    "ORDER BY search_documents_fts.rank, d.object_id"
+                ),
+                {"index": index, "query": expression},
+            ).fetchall()
+        # Also SQLite before the first reindex has created the FTS table.
+        table = self.table
+        return session.execute(
+            table.select()
+            .with_only_columns([table.c.object_id, table.c.payload])
+            .where(table.c.index_name == index)
+            .where(or_(*[table.c.content.contains(term) for term in terms]))
+            .order_by(table.c.object_id)
+        ).fetchall()
+
+    def _matches_filters(self, facets, filters, payload):
+        for name, selected in filters.items():
+            if not selected or name not in facets:
+                continue
+            [(kind, spec)] = facets[name].items()
+            values = _payload_values(payload, spec["field"])
+            if kind == "terms":
+                if not set(values) & set(selected):
+                    return False
+                continue
+            low, high = selected
+            if not any(
+                (low is None or value >= low) and (high is None or value <= high)
+                for value in values
+            ):
+                return False
+        return True
+
+    def _facet_buckets(self, facets, payloads):
+        buckets = dict()
+        for name, spec in facets.items():
+            [(kind, options)] = spec.items()
+            counts = Counter()
+            for payload in payloads:
+                values = set(_payload_values(payload, options["field"]))
+                if kind == "histogram":
+                    interval = options["interval"]
+                    values = {
+                        float(math.floor(value / interval) * interval)
+                        for value in values
+                    }
+                counts.update(values)
+            if kind == "terms":
+                # Same order as Elasticsearch: most documents first.
+                ordered = sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+                ordered = ordered[: options.get("size", 10)]
+            else:
+                ordered = [
+                    (key, count)
+                    for key, count in sorted(counts.items())
+                    if count >= options.get("min_doc_count", 0)
+                ]
+            buckets[name] = [{"key": key, "count": count} for key, count in ordered]
+        return buckets
+
+
+class IndexQueue(object):
+    """Deduplicating queue of pending index operations, kept in Redis.
+
+    The list holds ``<index>:<id>`` keys in arrival order. The hash maps each
+    key to ``<op>|<first enqueue time>``, so a repeated id only updates its
+    operation and keeps its place and age. Popped items wait in a second
+    hash until the worker acknowledges them, and go back to the queue if it
+    dies first.
+    """
+
+    LIST_KEY = "index-queue"
+    OPS_KEY = "index-queue:ops"
+    PROCESSING_KEY = "index-queue:processing"
+    LAG_KEY = "index-queue:lag"
+
+    ENQUEUE_SCRIPT = """
+        local previous = redis.call('HGET', KEYS[2], ARGV[1])
+        local enqueued_at = ARGV[3]
+        if previous then
+            enqueued_at = string.match(previous, '|(.*)$')
+        else
+            redis.call('RPUSH', KEYS[1], ARGV[1])
+        end
+        redis.call('HSET', KEYS[2], ARGV[1], ARGV[2] .. '|' .. enqueued_at)
+        return previous and 0 or 1
+    """
+
+    POP_SCRIPT = """
+        local keys = redis.call('LRANGE', KEYS[1], 0, ARGV[1] - 1)
+        if #keys > 0 then
+            redis.call('LTRIM', KEYS[1], #keys, -1)
+        end
+        local items = {}
+        for _, key in ipairs(keys) do
+            local value = redis.call('HGET', KEYS[2], key)
+            if value then
+                items[#items + 1] = key
+                items[#items + 1] = value
+                redis.call('HDEL', KEYS[2], key)
+                redis.call('HSET', KEYS[3], key, value)
+            end
+        end
+        return items
+    """
+
+    # Puts unacknowledged items back, unless they were queued again since.
+    RECOVER_SCRIPT = """
+        local processing = redis.call('HGETALL', KEYS[3])
+        for i = 1, #processing, 2 do
+            if redis.call('HSETNX', KEYS[2], processing[i], processing[i + 1]) == 1 then
+                redis.call('RPUSH', KEYS[1], processing[i])
+            end
+        end
+        redis.call('DEL', KEYS[3])
+        return #processing / 2
+    """
+
+    def __init__(self, app=None, redis_store=None):
+        self.redis_store = redis_store
+        self.enabled = False
+        if app:
+            self.init_app(app, redis_store)
+
+    def init_app(self, app, redis_store):
+        self.redis_store = redis_store
+        self.enabled = app.config["ELASTICSEARCH_INDEX_QUEUE"]
+        self._enqueue = redis_store.object.register_script(self.ENQUEUE_SCRIPT)
+        self._pop = redis_store.object.register_script(self.POP_SCRIPT)
+        self._recover = redis_store.object.register_script(self.RECOVER_SCRIPT)
+
+    @property
+    def keys(self):
+        return [self.LIST_KEY, self.OPS_KEY, self.PROCESSING_KEY]
+
+    def push(self, operations, enqueued_at=None):
+        """Queue ``(index, id, op)`` tuples."""
+        now = repr(time.time())
+        pipe = self.redis_store.object.pipeline(transaction=False)
+        for index, object_id, operation in operations:
+            self._enqueue(
+                keys=[self.LIST_KEY, self.OPS_KEY],
+                args=[f"{index}:{object_id}", operation, enqueued_at or now],
+                client=pipe,
+            )
+        pipe.execute()
+
+    def pop(self, count):
+        """Take up to ``count`` items as ``(index, id, op, enqueued_at)``.
+
+        They are kept until ``ack``, or ``recover`` after a crash.
+        """
+        flat = self._pop(keys=self.keys, args=[count])
+        items = list()
+        for key, value in zip(flat[::2], flat[1::2]):
+            index, object_id = key.rsplit(":", 1)
+            operation, enqueued_at = value.split("|", 1)
+            items.append((index, int(object_id), operation, float(enqueued_at)))
+        return items
+
+    def ack(self, items):
+        """Forget popped items, they were indexed or requeued."""
+        if items:
+            self.redis_store.object.hdel(
+                self.PROCESSING_KEY,
+                *(f"{index}:{object_id}" for index, object_id, _, _ in items),
+            )
+
+    def requeue(self, items):
+        for index, object_id, operation, enqueued_at in items:
+            self.push([(index, object_id, operation)], repr(enqueued_at))
+
+    def recover(self):
+        """Requeue items popped by a worker that never acknowledged them."""
+        return self._recover(keys=self.keys)
+
+    def lag(self):
+        """Age in seconds of the oldest pending operation."""
+        key = self.redis_store.object.lindex(self.LIST_KEY, 0)
+        value = key and self.redis_store.object.hget(self.OPS_KEY, key)
+        if not value:
+            return 0.0
+        return max(time.time() - float(value.split("|", 1)[1]), 0.0)
+
+    def record_lag(self, lag):
+        self.redis_store.object.set(self.LAG_KEY, repr(lag))
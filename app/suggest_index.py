@@ -0,0 +1,103 @@
+from bisect import bisect_left
+from operator import itemgetter
+from threading import Lock
+from time import monotonic
+from redis import RedisError
+from app import db, versions
+from app.models import Product, ProductBrand, ProductTag
+
+
+def _keys(name):
+    """Lookup keys for ``name``: the whole name and every word suffix."""
+    words = name.lower().split()
+    return {" ".join(words[index:]) for index in range(len(words))}
+
+
+class SuggestIndex(object):
+    """Sorted prefix index over product, brand and tag names.
+
+    Entries are ``(key, kind, name, slug)`` tuples sorted by key, with the
+    keys alongside for bisecting, so a prefix lookup is one bisect plus a
+    short scan. Like the tag index it is
+    rebuilt when a catalog write bumps the versions of its tables; since
+    it is read on every keystroke those are checked at most every
+    ``CHECK_INTERVAL`` seconds, writes made in this process invalidate it
+    right away.
+    """
+
+    CHECK_INTERVAL = 5
+
+    TABLES = (
+        Product.__tablename__,
+        ProductBrand.__tablename__,
+        ProductTag.__tablename__,
+    )
+    SOURCES = (
+        ("product", Product),
+        ("brand", ProductBrand),
+        ("tag", ProductTag),
+    )
+
+    def __init__(self):
+        self.lock = Lock()
+        self.version = None
+        self.stale = True
+        self.checked_at = 0.0
+        # (keys, entries), swapped as a whole on refresh.
+        self.entries = ([], [])
+
+    def warm_up(self):
+        try:
+            self.refresh()
+        except Exception as ex:
+            print(ex)
+
+    def invalidate(self):
+        self.stale = True
+
+    def refresh(self):
+        now = monotonic()
+        if not self.stale and now - self.checked_at < self.CHECK_INTERVAL:
+            return
+        with self.lock:
+            try:
+                version = versions.get(*self.TABLES)
+            except RedisError as ex:
+                print(ex)
+                version = None
+            self.checked_at = now
+            if not self.stale and version in (None, self.version):
+                return
+
+            entries = []
+            for kind, model in self.SOURCES:
+                for name, slug in db.session.query(model.name, model.slug).filter(
+                    model.active.is_(True)
+                ):
+                    entries.extend((key, kind, name, slug) for key in _keys(name))
+            entries.sort(key=itemgetter(0))
+            self.entries = ([entry[0] for entry in entries], entries)
+            self.version = version
+            self.stale = False
+
+    def suggest(self, prefix, limit=10):
+        """Names starting with ``prefix`` (at any word), in key order."""
+        self.refresh()
+        prefix = " ".join(prefix.lower().split())
+        if not prefix:
+            return []
+        keys, entries = self.entries
+        seen = set()
+        suggestions = []
+        for index in range(bisect_left(keys, prefix), len(keys)):
+            key, kind, name, slug = entries[index]
+            if not key.startswith(prefix) or len(suggestions) == limit:
+                break
+            if (kind, slug) in seen:
+                continue
+            seen.add((kind, slug))
+            suggestions.append({"kind": kind, "name": name, "slug": slug})
+        return suggestions
+
+
+suggest_index = SuggestIndex()
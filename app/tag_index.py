@@ -0,0 +1,188 @@
+from bisect import bisect_right
+from datetime import datetime
+from itertools import islice
+from threading import Lock
+from redis import RedisError
+from app import db, versions
+from app.models import Product, ProductTag, product_and_tag_assoc
+from app.utils import price_cents
+
+
+def _bitmap(product_ids):
+    ids = list(product_ids)
+    if not ids:
+        return 0
+    data = bytearray(max(ids) // 8 + 1)
+    for product_id in ids:
+        data[product_id >> 3] |= 1 << (product_id & 7)
+    return int.from_bytes(data, "little")
+
+
+def _popcount(bits):
+    return bin(bits).count("1")
+
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def _newest_key(date_created, product_id):
+    # date_created DESC, id DESC, NULL dates last.
+    if date_created is None:
+        return (1, 0, -product_id)
+    return (0, -(date_created - EPOCH).total_seconds(), -product_id)
+
+
+def _price_key(price, product_id):
+    return (price_cents(price), product_id)
+
+
+# Ascending keys giving the order of the product list sorts.
+SORT_KEYS = {
+    "newest": (Product.date_created, _newest_key),
+    "price": (Product.price, _price_key),
+}
+
+
+def _members(bits):
+    data = bits.to_bytes((bits.bit_length() + 7) // 8, "little")
+    return [
+        index * 8 + offset
+        for index, byte in enumerate(data)
+        if byte
+        for offset in range(8)
+        if byte >> offset & 1
+    ]
+
+
+class TagIndex(object):
+    """Tag slug -> product id bitmap, kept in process memory.
+
+    Bitmaps are plain ints with bit ``n`` set for product ``n``. Active
+    products are also kept in the order of every product list sort, so a
+    page of a bitmap is read without the database. The index remembers the
+    table versions it was built from and rebuilds itself when a catalog
+    write bumps them.
+    """
+
+    TABLES = (Product.__tablename__, ProductTag.__tablename__)
+
+    def __init__(self):
+        self.lock = Lock()
+        self.version = None
+        self.stale = True
+        # (tags, active, in_stock), swapped as a whole on refresh.
+        self.bitmaps = (dict(), 0, 0)
+        # sort -> (keys, product ids) of active products, in sort order.
+        self.orders = {sort: ([], []) for sort in SORT_KEYS}
+
+    def warm_up(self):
+        try:
+            self.refresh()
+        except Exception as ex:
+            print(ex)
+
+    def invalidate(self):
+        self.stale = True
+
+    def refresh(self):
+        with self.lock:
+            try:
+                version = versions.get(*self.TABLES)
+            except RedisError as ex:
+                print(ex)
+                version = None
+            if not self.stale and version in (None, self.version):
+                return
+
+            products = db.session.query(
+                Product.id,
+                Product.active,
+                Product.in_stock,
+                *(column for column, _ in SORT_KEYS.values()),
+            ).all()
+            tag_members = dict()
+            for slug, product_id in (
+                db.session.query(ProductTag.slug, product_and_tag_assoc.c.product_id)
+                .join(
+                    product_and_tag_assoc,
+                    product_and_tag_assoc.c.product_tag_id == ProductTag.id,
+                )
+                .filter(product_and_tag_assoc.c.product_id.isnot(None))
+            ):
+                tag_members.setdefault(slug, []).append(product_id)
+
+            self.bitmaps = (
+                {slug: _bitmap(ids) for slug, ids in tag_members.items()},
+                _bitmap(product[0] for product in products if product[1]),
+                _bitmap(product[0] for product in products if product[2]),
+            )
+            orders = dict()
+            for position, (sort, (_, make_key)) in enumerate(SORT_KEYS.items(), 3):
+                ordered = sorted(
+                    (make_key(product[position], product[0]), product[0])
+                    for product in products
+                    if product[1]
+                )
+                orders[sort] = (
+                    [key for key, _ in ordered],
+                    [product_id for _, product_id in ordered],
+                )
+            self.orders = orders
+            self.version = version
+            self.stale = False
+
+    def match(self, tags=None, match_all=False, in_stock=None):
+        """Bitmap of active products carrying any (or all) of ``tags``."""
+        self.refresh()
+        tag_bitmaps, bits, in_stock_bits = self.bitmaps
+        if tags:
+            tag_bits = [tag_bitmaps.get(slug, 0) for slug in tags]
+            if match_all:
+                for tag in tag_bits:
+                    bits &= tag
+            else:
+                combined = 0
+                for tag in tag_bits:
+                    combined |= tag
+                bits &= combined
+        if in_stock is not None:
+            bits = bits & in_stock_bits if in_stock else bits & ~in_stock_bits
+        return bits
+
+    def facets(self, bits):
+        """Number of products in ``bits`` per tag slug."""
+        tag_bitmaps = self.bitmaps[0]
+        counts = [(slug, _popcount(bits & tag)) for slug, tag in tag_bitmaps.items()]
+        return [
+            {"slug": slug, "count": count} for slug, count in sorted(counts) if count
+        ]
+
+    def product_ids(self, bits):
+        return _members(bits)
+
+    def page(self, bits, sort, limit, offset=0, after=None):
+        """Up to ``limit`` ids of ``bits`` in ``sort`` order.
+
+        The page starts ``offset`` ids in, or right after the ``(value,
+        id)`` keyset position ``after``.
+        """
+        keys, product_ids = self.orders[sort]
+        start = 0
+        if after is not None:
+            start = bisect_right(keys, SORT_KEYS[sort][1](*after))
+        data = bits.to_bytes((bits.bit_length() + 7) // 8, "little")
+        page = []
+        for product_id in islice(product_ids, start, None):
+            byte = product_id >> 3
+            if byte >= len(data) or not data[byte] >> (product_id & 7) & 1:
+                continue
+            if offset:
+                offset -= 1
+                continue
+            page.append(product_id)
+            if len(page) == limit:
+                break
+        return page
+
+
+tag_index = TagIndex()
@@ -1,6 +1,11 @@
 from sqlalchemy.sql.expression import ClauseElement
 from flask_mail import Message
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from decimal import Decimal
 from app import mail
+import json
+
+CENT = Decimal("0.01")
 
 
 def get_or_create(model, session, defaults=None, **kwargs):
@@ -22,3 +27,21 @@ def send_email(subject, sender, recipients, text_body, html_body):
     msg.body = text_body
     msg.html = html_body
     mail.send(msg)
+
+
+def encode_cursor(values):
+    data = json.dumps(values, separators=(",", ":"), sort_keys=True)
+    return urlsafe_b64encode(data.encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        return json.loads(urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        return None
+
+
+def price_cents(price):
+    # Product.price is a single precision FLOAT, keysets compare it as
+    # DECIMAL(10,2) so a cursor matches the rows it was read from.
+    return Decimal(price).quantize(CENT)
@@ -0,0 +1,120 @@
+from flask import request, Response
+from flask_restplus.utils import unpack
+from werkzeug.http import http_date, quote_etag
+from datetime import datetime
+from functools import wraps
+from redis import RedisError
+import hashlib
+import json
+import time
+
+
+class VersionStore(object):
+    """Change stamps for tables and single resources, kept in Redis.
+
+    A version is the time of the last bump, so a wiped Redis never hands
+    out a version that was already used.
+    """
+
+    KEY = "versions"
+
+    def __init__(self, redis_store=None):
+        self.redis_store = redis_store
+        self.ttl = None
+
+    def init_app(self, app, redis_store):
+        self.redis_store = redis_store
+        self.ttl = app.config["RESPONSE_CACHE_TTL"]
+
+    def bump(self, *names):
+        if not names:
+            return
+        now = repr(time.time())
+        try:
+            self.redis_store.object.hmset(self.KEY, {name: now for name in names})
+        except RedisError as ex:
+            print(ex)
+
+    def get(self, *names):
+        versions = self.redis_store.object.hmget(self.KEY, names)
+        return [float(version) if version else 0.0 for version in versions]
+
+    def memoize(self, names, key, compute):
+        """JSON value of ``compute()`` kept at ``key`` while ``names`` hold.
+
+        The versions are read in the same round trip as the entry, and an
+        entry stored under older versions is recomputed.
+        """
+        try:
+            pipe = self.redis_store.object.pipeline(transaction=False)
+            pipe.hmget(self.KEY, names)
+            pipe.get(key)
+            versions, entry = pipe.execute()
+        except RedisError as ex:
+            print(ex)
+            return compute()
+        version = ",".join(version or "0" for version in versions)
+        if entry is not None:
+            entry = json.loads(entry)
+            if entry["version"] == version:
+                return entry["value"]
+
+        value = compute()
+        try:
+            self.redis_store.object.set(
+                key, json.dumps({"version": version, "value": value}), ex=self.ttl
+            )
+        except RedisError as ex:
+            print(ex)
+        return value
+
+    def conditional(self, *names):
+        """Emit ETag/Last-Modified and answer 304 before the view runs.
+
+        ``names`` are version names or callables building one from the
+        view arguments.
+        """
+
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                resolved = [
+                    name(**kwargs) if callable(name) else name for name in names
+                ]
+                try:
+                    versions = self.get(*resolved)
+                except RedisError as ex:
+                    print(ex)
+                    return func(*args, **kwargs)
+
+                etag = self._make_etag(versions)
+                headers = {"ETag": quote_etag(etag)}
+                last_modified = max(versions)
+                if last_modified:
+                    headers["Last-Modified"] = http_date(last_modified)
+
+                if request.if_none_match:
+                    not_modified = request.if_none_match.contains_weak(etag)
+                elif request.if_modified_since and last_modified:
+                    modified_at = datetime.utcfromtimestamp(int(last_modified))
+                    not_modified = request.if_modified_since >= modified_at
+                else:
+                    not_modified = False
+                if not_modified:
+                    return Response(status=304, headers=headers)
+
+                data, code, response_headers = unpack(func(*args, **kwargs))
+                if code == 200:
+                    response_headers = dict(response_headers or {}, **headers)
+                return data, code, response_headers
+
+            return wrapper
+
+        return decorator
+
+    def _make_etag(self, versions):
+        args = sorted((name, sorted(values)) for name, values in request.args.lists())
+        view_args = sorted((request.view_args or {}).items())
+        return hashlib.sha1(
+            json.dumps([request.endpoint, view_args, args, versions]).encode()
+        ).hexdigest()